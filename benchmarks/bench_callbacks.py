@@ -0,0 +1,48 @@
+# Бенчмарк формата callback_data: размер и скорость разбора прежних строк
+# "action:argument" против компактного версионированного формата. Для
+# сравнения приведён голый str.partition — нижняя граница прежнего разбора.
+# Запуск: python benchmarks/bench_callbacks.py
+import functools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+ROUNDS = 50000
+
+
+def callback_keys(catalog):
+    # Канонические ключи всех кнопок каталога, включая формы заявок
+    keys = []
+    for screen in catalog.screens.values():
+        for row in screen.reply_markup.inline_keyboard:
+            for button in row:
+                keys.append(bot.callback_key(catalog, button.callback_data))
+    return keys
+
+
+def timed(decode, payloads):
+    n = len(payloads)
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        decode(payloads[i % n])
+    return (time.perf_counter() - start) / ROUNDS * 1e9
+
+
+def main():
+    catalog = bot.CATALOG
+    legacy = callback_keys(catalog)
+    compact = [bot.encode_callback(catalog, key) for key in legacy]
+    print(f"{'формат':>10} {'средний, байт':>14} {'макс, байт':>11} {'разбор, нс':>11}")
+    decode = functools.partial(bot.decode_callback, catalog)
+    rows = (("partition", legacy, bot.parse_callback), ("прежний", legacy, decode), ("компактный", compact, decode))
+    for name, payloads, parse in rows:
+        sizes = [len(data.encode()) for data in payloads]
+        print(f"{name:>10} {sum(sizes) / len(sizes):>14.1f} {max(sizes):>11} {timed(parse, payloads):>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
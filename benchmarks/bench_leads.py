@@ -0,0 +1,55 @@
+# Бенчмарк записи заявок: пачками через LeadWriter против записи по одной.
+# Запуск: python benchmarks/bench_leads.py [--leads 5000]
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def lead(i):
+    return {
+        "ts": time.time(),
+        "user_id": 100000 + i,
+        "username": f"user{i}",
+        "full_name": f"User {i}",
+        "item": "svc_show:base_44",
+        "name": "Базовое сопровождение по 44-ФЗ",
+        "price": "от 7000 ₽",
+        "addons": ["svc_show:urgent_44"],
+        "catalog_version": "bench",
+    }
+
+
+async def measure(path, batch_size, leads):
+    writer = bot.LeadWriter(path, batch_size, flush_interval=0.05, queue_size=leads + 1)
+    writer.start()
+    records = [lead(i) for i in range(leads)]
+    start = time.perf_counter()
+    for record in records:
+        writer.submit(record)
+    submit = (time.perf_counter() - start) / leads * 1e6
+    await writer.stop(timeout=600)
+    elapsed = time.perf_counter() - start
+    return leads / elapsed, submit, writer.batches
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--leads", type=int, default=5000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'размер пачки':>13} {'заявок/с':>10} {'постановка, мкс':>16} {'записей в файл':>15}")
+        for batch_size in (1, 10, 100, 1000):
+            path = os.path.join(tmp, f"leads_{batch_size}.jsonl")
+            throughput, submit, batches = await measure(path, batch_size, args.leads)
+            print(f"{batch_size:>13} {throughput:>10.0f} {submit:>16.2f} {batches:>15}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+# Бенчмарк накладных расходов метрик на один апдейт.
+# Запуск: python benchmarks/bench_metrics.py
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Dispatcher, types  # noqa: E402
+
+import bot  # noqa: E402
+
+UPDATES = 20000
+
+
+def make_update(i):
+    return types.Update.model_validate({
+        "update_id": i,
+        "callback_query": {
+            "id": str(i),
+            "from": {"id": i % 100, "is_bot": False, "first_name": "u"},
+            "chat_instance": "bench",
+            "data": "ecp_type:fl",
+        },
+    }, context={"bot": bot.bot})
+
+
+def make_dispatcher(instrumented):
+    dp = Dispatcher()
+
+    @dp.callback_query()
+    async def noop(callback: types.CallbackQuery):
+        return None
+
+    if instrumented:
+        dp.update.outer_middleware(bot.UpdateMetricsMiddleware())
+        dp.callback_query.middleware(bot.HandlerMetricsMiddleware())
+    return dp
+
+
+async def run(dp, updates):
+    start = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot.bot, update)
+    return (time.perf_counter() - start) / len(updates) * 1e6
+
+
+async def main():
+    updates = [make_update(i) for i in range(UPDATES)]
+    plain = await run(make_dispatcher(False), updates)
+    instrumented = await run(make_dispatcher(True), updates)
+    start = time.perf_counter()
+    text = bot.metrics.render()
+    render = (time.perf_counter() - start) * 1000
+    print(f"Без метрик:  {plain:8.1f} мкс/апдейт")
+    print(f"С метриками: {instrumented:8.1f} мкс/апдейт")
+    print(f"Накладные расходы: {instrumented - plain:.1f} мкс/апдейт ({(instrumented / plain - 1) * 100:.1f}%)")
+    print(f"Рендер /metrics: {render:.2f} мс, {len(text)} байт")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+# Бенчмарк маршрутизации: цепочка lambda-фильтров против таблицы CALLBACK_ROUTES.
+# Запуск: python benchmarks/bench_router.py
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+ROUNDS = 50000
+
+
+def handler(*args):
+    return args
+
+
+def build_linear(sections):
+    # Так aiogram перебирает обработчики: фильтры проверяются по очереди
+    filters = []
+    for i in range(sections):
+        filters.append((lambda c, p=f"sec{i}_show:": c.startswith(p), handler))
+        filters.append((lambda c, p=f"sec{i}:", q=f"sec{i}_show:": c.startswith(p) and not c.startswith(q), handler))
+    return filters
+
+
+def route_linear(filters, data):
+    for check, func in filters:
+        if check(data):
+            return func(data, data.split(":")[1])
+    return None
+
+
+def build_table(sections):
+    routes = {}
+    for i in range(sections):
+        routes[f"sec{i}_show"] = handler
+        routes[f"sec{i}"] = handler
+    return routes
+
+
+def route_table(routes, data):
+    action, argument = bot.parse_callback(data)
+    func = routes.get(action)
+    if func is not None:
+        return func(data, argument)
+    return None
+
+
+def timed(func, table, payloads):
+    n = len(payloads)
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        func(table, payloads[i % n])
+    return (time.perf_counter() - start) / ROUNDS * 1e9
+
+
+def main():
+    print(f"{'разделов':>9} {'фильтры, нс':>14} {'таблица, нс':>14}")
+    for sections in (10, 50, 100, 500, 1000):
+        # Худший для фильтров случай — последние разделы
+        payloads = [f"sec{sections - 1 - k}_show:item{k}" for k in range(5)]
+        linear = timed(route_linear, build_linear(sections), payloads)
+        table = timed(route_table, build_table(sections), payloads)
+        print(f"{sections:>9} {linear:>14.0f} {table:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
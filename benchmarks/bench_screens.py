@@ -0,0 +1,82 @@
+# Микробенчмарк: построение экрана на каждое нажатие против поиска в реестре экранов.
+# Запуск: python benchmarks/bench_screens.py
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+TAPS = 20000
+
+
+def tap_keys():
+    return [
+        "ecp_main", "ecp_type:fl", "ecp_show:ftp", "ecp_type:fl", "crypto_main",
+        "crypto_show:rt_3", "services_main", "proc:44fz", "struct_menu",
+        "svc_show:struct_41_80", "svc:other", "svc_show:fas",
+    ]
+
+
+def render_uncached(key):
+    # Повторяет прежнюю логику обработчиков: сборка клавиатуры и текста на каждый запрос
+    catalog = bot.CATALOG
+    action, _, arg = key.partition(":")
+    if action == "ecp_main":
+        return bot.render_ecp_main(catalog)
+    if action == "ecp_type":
+        return bot.render_ecp_type(catalog, arg)
+    if action == "ecp_show":
+        return bot.render_ecp_details(catalog, arg)
+    if action == "crypto_main":
+        return bot.render_crypto_main(catalog)
+    if action == "crypto_show":
+        return bot.render_crypto_details(catalog, arg)
+    if action == "services_main":
+        return bot.render_services_main(catalog)
+    if action == "proc":
+        return bot.render_proc_list(catalog, arg)
+    if action == "struct_menu":
+        return bot.render_structure_menu(catalog)
+    if action == "svc":
+        return bot.render_other_services(catalog, arg)
+    return bot.render_service_details(catalog, arg)
+
+
+def render_cached(key):
+    return bot.CATALOG.screens[key]
+
+
+def measure(name, func):
+    keys = tap_keys()
+    n = len(keys)
+    start = time.process_time()
+    for i in range(TAPS):
+        func(keys[i % n])
+    elapsed = time.process_time() - start
+
+    tracemalloc.start()
+    for i in range(1000):
+        func(keys[i % n])
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocs = sum(stat.count for stat in snapshot.statistics("filename"))
+
+    print(f"{name:<12} {elapsed / TAPS * 1e6:>10.2f} мкс/нажатие   пик {peak / 1024:>8.1f} КиБ   живых блоков {allocs}")
+    return elapsed
+
+
+def main():
+    start = time.perf_counter()
+    screens = bot.build_screens(bot.CATALOG)
+    print(f"Сборка реестра: {len(screens)} экранов за {(time.perf_counter() - start) * 1000:.1f} мс")
+    uncached = measure("на запрос", render_uncached)
+    cached = measure("реестр", render_cached)
+    print(f"Ускорение: x{uncached / max(cached, 1e-9):.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+# Бенчмарк поиска: время построения индекса и задержка запросов.
+# Запуск: python benchmarks/bench_search.py
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+BUILDS = 50
+ROUNDS = 2000
+QUERIES = [
+    "ФТС Альта-Софт", "Жалоба в ФАС", "жал", "рутокен", "крипто про",
+    "поиск торгов", "44", "регистрация еруз", "банкротство", "м",
+]
+
+
+def main():
+    catalog = bot.CATALOG
+    start = time.perf_counter()
+    for _ in range(BUILDS):
+        index = bot.build_search_index(catalog)
+    build = (time.perf_counter() - start) / BUILDS
+    print(f"Индекс: {len(index.docs)} позиций, {len(index.stems)} основ, построение {build * 1000:.2f} мс")
+
+    print(f"{'запрос':<20} {'найдено':>8} {'мкс':>8}")
+    worst = 0.0
+    for query in QUERIES:
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            results = index.search(query)
+        latency = (time.perf_counter() - start) / ROUNDS * 1e6
+        worst = max(worst, latency)
+        print(f"{query:<20} {len(results):>8} {latency:>8.1f}")
+    print(f"Худшая задержка: {worst:.1f} мкс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Нагрузочный тест многопроцессного режима: пропускная способность
+# в зависимости от числа воркеров на локальном фейковом Bot API.
+# Запуск: python benchmarks/bench_shards.py [--updates 3000] [--workers 1 2 4]
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_bot_api  # noqa: E402
+from traffic import callback_update  # noqa: E402
+
+PORT = 8091
+CHATS = 500
+os.environ.update({
+    "TELEGRAM_API_URL": f"http://127.0.0.1:{PORT}",
+    "CATALOG_WATCH_INTERVAL": "0",
+    "SEND_GLOBAL_RATE": "1000000",
+    "SEND_CHAT_RATE": "1000000",
+    "SEND_CHAT_BURST": "1000000",
+    "SEND_EDIT_RATE": "1000000",
+    "SEND_EDIT_BURST": "1000000",
+    "FLOOD_RATE": "0",
+    "FLOOD_DUPLICATE_WINDOW": "0",
+})
+
+import bot  # noqa: E402
+
+PATHS = ["ecp_main", "ecp_type:fl", "ecp_show:ftp", "crypto_main", "services_main", "proc:44fz", "svc_show:base_44"]
+
+
+def processed(pool):
+    return sum(counter.value for counter in pool.processed)
+
+
+def wait_processed(pool, target, timeout=120):
+    deadline = time.monotonic() + timeout
+    while processed(pool) < target:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"обработано {processed(pool)} из {target}")
+        time.sleep(0.01)
+
+
+def measure(workers, updates):
+    pool = bot.ShardPool(workers, updates + workers)
+    pool.start()
+    # Прогрев: по одному апдейту на шард, чтобы воркеры импортировали модуль
+    for shard in range(workers):
+        pool.put(callback_update(shard, shard, "ecp_main"))
+    wait_processed(pool, workers)
+
+    start = time.perf_counter()
+    for i in range(updates):
+        chat_id = CHATS + i % CHATS
+        while not pool.put(callback_update(workers + i, chat_id, PATHS[i % len(PATHS)])):
+            time.sleep(0.001)
+    wait_processed(pool, workers + updates)
+    elapsed = time.perf_counter() - start
+
+    asyncio.run(pool.stop(10))
+    return updates / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=3000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = multiprocessing.get_context("spawn").Process(
+        target=fake_bot_api.run, kwargs={"port": PORT, "latency": args.latency}, daemon=True
+    )
+    server.start()
+    time.sleep(1)
+    try:
+        print(f"ядер: {os.cpu_count()}, апдейтов: {args.updates}")
+        print(f"{'воркеров':>9} {'апдейтов/с':>12}")
+        for workers in args.workers:
+            throughput = measure(workers, args.updates)
+            print(f"{workers:>9} {throughput:>12.0f}")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
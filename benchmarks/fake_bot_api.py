@@ -0,0 +1,134 @@
+# Локальная замена Telegram Bot API для нагрузочных тестов.
+# Запуск: python benchmarks/fake_bot_api.py [--port 8081] [--latency 0.02] [--flood-rate 0.01]
+# Боту нужно передать TELEGRAM_API_URL=http://127.0.0.1:8081
+import argparse
+import asyncio
+import random
+import time
+
+from aiohttp import web
+
+# Методы отправки, на которые распространяются искусственные ошибки и 429
+SEND_METHODS = {"sendmessage", "editmessagetext", "answercallbackquery", "answerinlinequery"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.errors = {}
+        self.started = time.time()
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.message_ids = {}
+
+    def push_updates(self, updates):
+        # Апдейты, которые отдаст getUpdates
+        self.updates.extend(updates)
+        self.new_updates.set()
+
+    def user(self):
+        return {"id": 1, "is_bot": True, "first_name": "Fake Bot", "username": "fake_bot"}
+
+    def message(self, name, params):
+        chat_id = int(params.get("chat_id") or 1)
+        if name == "sendmessage":
+            message_id = self.message_ids[chat_id] = self.message_ids.get(chat_id, 0) + 1
+        else:
+            message_id = int(params.get("message_id") or 1)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": self.user(),
+            "text": params.get("text", ""),
+        }
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    def fail(self, name, status, description, **parameters):
+        self.errors[name] = self.errors.get(name, 0) + 1
+        payload = {"ok": False, "error_code": status, "description": description}
+        if parameters:
+            payload["parameters"] = parameters
+        return web.json_response(payload, status=status)
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        name = method.lower()
+        if name == "getupdates":
+            return web.json_response({"ok": True, "result": await self.get_updates(params)})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if name in SEND_METHODS:
+            roll = self.random.random()
+            if roll < self.flood_rate:
+                return self.fail(method, 429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after)
+            if roll < self.flood_rate + self.error_rate:
+                return self.fail(method, 500, "Internal Server Error")
+        if name == "getme":
+            result = self.user()
+        elif name in ("sendmessage", "editmessagetext"):
+            result = self.message(name, params)
+        elif name in ("answercallbackquery", "deletewebhook", "setwebhook", "answerinlinequery"):
+            result = True
+        else:
+            return self.fail(method, 404, "Not Found: method not found")
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(self, request: web.Request):
+        return web.json_response({"calls": self.calls, "errors": self.errors, "uptime": time.time() - self.started})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/_stats", self.stats)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081):
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def run(host: str = "127.0.0.1", port: int = 8081, latency: float = 0.0,
+        error_rate: float = 0.0, flood_rate: float = 0.0, retry_after: int = 1):
+    async def make():
+        return FakeBotAPI(latency, error_rate, flood_rate, retry_after).make_app()
+    web.run_app(make(), host=host, port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный фейковый Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500 на методы отправки")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля ответов 429 на методы отправки")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    args = parser.parse_args()
+    run(args.host, args.port, args.latency, args.error_rate, args.flood_rate, args.retry_after)
+
+
+if __name__ == "__main__":
+    main()
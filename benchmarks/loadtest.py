@@ -0,0 +1,140 @@
+# Нагрузочный прогон bot.py на фейковом Bot API: апдейты/с, p50/p99
+# длительности обработки апдейта и потребление памяти во времени.
+# Запуск: python benchmarks/loadtest.py [--users 200] [--steps 20] [--latency 0.02] [--flood-rate 0.01]
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+PORT = int(os.getenv("LOADTEST_PORT", 8092))
+os.environ.setdefault("TELEGRAM_API_URL", f"http://127.0.0.1:{PORT}")
+os.environ.setdefault("CATALOG_WATCH_INTERVAL", "0")
+# Пути пользователей проигрываются без пауз: антифлуд отбросил бы большую часть шагов
+os.environ.setdefault("FLOOD_RATE", "0")
+os.environ.setdefault("FLOOD_DUPLICATE_WINDOW", "0")
+
+from aiogram import BaseMiddleware  # noqa: E402
+
+import traffic  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Recorder(BaseMiddleware):
+    def __init__(self, total):
+        self.total = total
+        self.durations = []
+        self.done = asyncio.Event()
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.durations.append(time.perf_counter() - started)
+            if len(self.durations) >= self.total:
+                self.done.set()
+
+
+async def sample_memory(samples, started, interval):
+    while True:
+        samples.append((time.perf_counter() - started, rss_mb()))
+        await asyncio.sleep(interval)
+
+
+async def run(args):
+    # bot импортируется после разбора аргументов: настройки читаются из окружения при импорте
+    import bot
+
+    api = FakeBotAPI(args.latency, args.error_rate, args.flood_rate, args.retry_after, args.seed)
+    runner = await api.start(port=PORT)
+    updates = traffic.navigation_updates(bot.CATALOG, args.users, args.steps, args.seed)
+    recorder = Recorder(len(updates))
+    bot.dp.update.outer_middleware(recorder)
+
+    polling = asyncio.create_task(bot.dp.start_polling(bot.bot, handle_signals=False, polling_timeout=1))
+    await asyncio.sleep(0.5)
+    samples = []
+    started = time.perf_counter()
+    sampler = asyncio.create_task(sample_memory(samples, started, args.sample_interval))
+    api.push_updates(updates)
+    try:
+        await asyncio.wait_for(recorder.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Таймаут: обработано {len(recorder.durations)} из {len(updates)}")
+    elapsed = time.perf_counter() - started
+    samples.append((elapsed, rss_mb()))
+    sampler.cancel()
+
+    await bot.dp.stop_polling()
+    await polling
+    await bot.bot.session.close()
+    await runner.cleanup()
+
+    durations = recorder.durations
+    report = {
+        "updates": len(durations),
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(durations) / elapsed, 1),
+        "p50_ms": round(percentile(durations, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(durations, 0.99) * 1000, 2),
+        "rss_mb": [(round(t, 1), round(m, 1)) for t, m in samples],
+        "api_calls": api.calls,
+        "api_errors": api.errors,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на фейковом Bot API")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка Bot API, с")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="период замера памяти, с")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--unthrottled", action="store_true", help="снять лимиты планировщика отправки")
+    parser.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    args = parser.parse_args()
+    if args.unthrottled:
+        os.environ.update({"SEND_GLOBAL_RATE": "1000000", "SEND_CHAT_RATE": "1000000", "SEND_CHAT_BURST": "1000000",
+                           "SEND_EDIT_RATE": "1000000", "SEND_EDIT_BURST": "1000000"})
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+        return
+    print(f"Апдейтов: {report['updates']} за {report['seconds']} с → {report['updates_per_sec']} апдейтов/с")
+    print(f"Обработка апдейта: p50 {report['p50_ms']} мс, p99 {report['p99_ms']} мс")
+    print("Память (RSS, МиБ): " + ", ".join(f"{t}с={m}" for t, m in report["rss_mb"]))
+    print(f"Вызовы API: {report['api_calls']}")
+    if report["api_errors"]:
+        print(f"Ошибки API: {report['api_errors']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Генератор синтетических апдейтов: пользователи ходят по дереву меню
+# так же, как по кнопкам реального каталога (ecp_main → ecp_type:fl → ecp_show:ftp ...).
+import random
+
+BACK_PROBABILITY = 0.3
+
+
+def screen_links(catalog):
+    # ключ экрана -> список переходов (callback_data, ключ целевого экрана) из его клавиатуры
+    from bot import callback_key
+
+    links = {}
+    for key, screen in catalog.screens.items():
+        markup = screen.reply_markup
+        rows = markup.inline_keyboard if markup is not None else []
+        links[key] = [
+            (button.callback_data, callback_key(catalog, button.callback_data))
+            for row in rows for button in row if button.callback_data
+        ]
+    return links
+
+
+def start_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+def callback_update(update_id, user_id, data, message_id=1):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": 0,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Fake Bot"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def navigation_paths(catalog, users, steps, seed=0):
+    # Для каждого пользователя: /start и случайная прогулка по кнопкам;
+    # в путь попадает callback_data нажатой кнопки
+    from bot import encode_callback
+
+    rnd = random.Random(seed)
+    links = screen_links(catalog)
+    paths = []
+    for _ in range(users):
+        current = (encode_callback(catalog, "back_to_main"), "back_to_main")
+        history = []
+        path = []
+        for _ in range(steps):
+            choices = [link for link in links.get(current[1], []) if link[1] in links]
+            if history and (not choices or rnd.random() < BACK_PROBABILITY):
+                current = history.pop()
+            elif choices:
+                history.append(current)
+                current = rnd.choice(choices)
+            path.append(current[0])
+        paths.append(path)
+    return paths
+
+
+def navigation_updates(catalog, users, steps, seed=0, first_user_id=100000, first_update_id=1):
+    # Пользователи перемежаются, порядок шагов внутри одного чата сохраняется
+    paths = navigation_paths(catalog, users, steps, seed)
+    update_id = first_update_id
+    updates = []
+    for user in range(users):
+        updates.append(start_update(update_id, first_user_id + user))
+        update_id += 1
+    for step in range(steps):
+        for user, path in enumerate(paths):
+            updates.append(callback_update(update_id, first_user_id + user, path[step]))
+            update_id += 1
+    return updates
@@ -1,24 +1,155 @@
 import os
+import re
+import sys
+import queue
+import atexit
+import copy
+import random
+import sqlite3
+import json
+import time
+import bisect
 import asyncio
+import hmac
+import hashlib
 import logging
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+import logging.handlers
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
+from aiogram.filters import Command, CommandObject
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
-from fastapi import FastAPI
+from aiogram import methods
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.utils.backoff import Backoff, BackoffConfig
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+import aiofiles
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import PlainTextResponse
 import uvicorn
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
+from typing import NamedTuple, Optional
 
 # =============================
 # НАСТРОЙКА ЛОГИРОВАНИЯ
 # =============================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Обработчики только кладут запись в ограниченную очередь, JSON собирается
+# и пишется в stderr фоновым потоком. При переполнении запись отбрасывается
+# и учитывается, цикл событий не ждёт. Массовые события (навигация, отчёты
+# aiogram об апдейтах, журнал запросов uvicorn) пишутся с вероятностью LOG_SAMPLE_RATE, предупреждения
+# и ошибки — всегда.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.1))
+SAMPLED_LOGGERS = {"aiogram.event", "uvicorn.access"}
+
+# Поля текущего апдейта (update_id, user_id) для всех записей его обработки
+log_context: ContextVar[Optional[dict]] = ContextVar("log_context", default=None)
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate: float, loggers):
+        super().__init__()
+        self.rate = rate
+        self.loggers = loggers
+        self.skipped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if getattr(record, "sampled", False) or record.name in self.loggers:
+            if random.random() >= self.rate:
+                self.skipped += 1
+                return False
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Сообщение и трассировка вычисляются сразу (аргументы могут измениться),
+    # сам JSON — уже в потоке записи. Как и в QueueHandler, меняется копия
+    # записи: остальные обработчики видят исходную
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.context = log_context.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogWriter(logging.handlers.QueueListener):
+    # При остановке ждём места под сигнал завершения, чтобы дописать буфер
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ("handler", "duration_ms")
+
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        entry.update(getattr(record, "context", None) or {})
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging():
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE, SAMPLED_LOGGERS))
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    writer = LogWriter(log_queue, stream)
+    writer.start()
+    atexit.register(writer.stop)
+    return handler, writer
+
+def logging_stats():
+    return {
+        "queued": log_handler.queue.qsize(),
+        "dropped": log_handler.dropped,
+        "sampled_out": log_handler.filters[0].skipped,
+    }
+
+log_handler, log_writer = setup_logging()
 logger = logging.getLogger(__name__)
 
+class LogContextMiddleware(BaseMiddleware):
+    # Внешний middleware апдейтов: проставляет update_id и user_id в записи лога
+    async def __call__(self, handler, event: types.Update, data):
+        user = data.get("event_from_user")
+        token = log_context.set({"update_id": event.update_id, "user_id": user.id if user else None})
+        try:
+            return await handler(event, data)
+        finally:
+            log_context.reset(token)
+
 # =============================
 # НАСТРОЙКА БОТА
 # =============================
@@ -28,8 +159,131 @@ if not BOT_TOKEN:
     logger.error("❌ Токен бота не найден!")
     exit(1)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+# Адрес Bot API (например, локальный telegram-bot-api или тестовый сервер)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+# Пул HTTP-соединений к Bot API
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 0))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 60))
+# Поллинг и перезапуск после сбоев
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 30))
+polling_backoff = BackoffConfig(
+    min_delay=float(os.getenv("BACKOFF_MIN_DELAY", 1)),
+    max_delay=float(os.getenv("BACKOFF_MAX_DELAY", 60)),
+    factor=float(os.getenv("BACKOFF_FACTOR", 2)),
+    jitter=float(os.getenv("BACKOFF_JITTER", 0.5)),
+)
+
+class PooledSession(AiohttpSession):
+    # Одна сессия и один пул соединений на всё время жизни процесса,
+    # перезапуски поллинга её не закрывают
+    def __init__(self, limit: int, limit_per_host: int, keepalive_timeout: float, **kwargs):
+        super().__init__(limit=limit, **kwargs)
+        self._connector_init.update(limit_per_host=limit_per_host, keepalive_timeout=keepalive_timeout)
+
+# Хранилище FSM (корзина расчёта и т.п.): по умолчанию в памяти с лимитом
+# ключей и временем жизни, FSM_STORAGE_URL=redis://... — Redis (нужен пакет redis)
+FSM_STORAGE_URL = os.getenv("FSM_STORAGE_URL", "")
+FSM_MAX_KEYS = int(os.getenv("FSM_MAX_KEYS", 100000))
+FSM_TTL = float(os.getenv("FSM_TTL", 24 * 3600))
+
+class BoundedMemoryStorage(BaseStorage):
+    # Как MemoryStorage aiogram, но записи живут FSM_TTL секунд с последнего
+    # обращения и вытесняются по LRU сверх FSM_MAX_KEYS. Чтение отсутствующего
+    # ключа запись не создаёт, пустые записи удаляются сразу.
+    def __init__(self, max_keys: int, ttl: float):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.records = OrderedDict()  # StorageKey -> [state, data, expires_at]
+        self.evicted = 0
+        self.expired = 0
+
+    def _get(self, key: StorageKey):
+        record = self.records.get(key)
+        if record is None:
+            return None
+        now = time.monotonic()
+        if record[2] <= now:
+            del self.records[key]
+            self.expired += 1
+            return None
+        record[2] = now + self.ttl
+        self.records.move_to_end(key)
+        return record
+
+    def _put(self, key: StorageKey, state, data):
+        if state is None and not data:
+            self.records.pop(key, None)
+            return
+        self.records[key] = [state, data, time.monotonic() + self.ttl]
+        self.records.move_to_end(key)
+        # Порядок записей совпадает с порядком истечения: просроченные — в начале
+        now = time.monotonic()
+        while self.records:
+            oldest = next(iter(self.records.values()))
+            if oldest[2] > now:
+                break
+            self.records.popitem(last=False)
+            self.expired += 1
+        while len(self.records) > self.max_keys:
+            self.records.popitem(last=False)
+            self.evicted += 1
+
+    async def set_state(self, key: StorageKey, state=None):
+        record = self._get(key)
+        self._put(key, state.state if isinstance(state, State) else state, record[1] if record else {})
+
+    async def get_state(self, key: StorageKey):
+        record = self._get(key)
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data):
+        record = self._get(key)
+        self._put(key, record[0] if record else None, dict(data))
+
+    async def get_data(self, key: StorageKey):
+        record = self._get(key)
+        return dict(record[1]) if record else {}
+
+    async def close(self):
+        self.records.clear()
+
+    def stats(self):
+        return {"keys": len(self.records), "evicted": self.evicted, "expired": self.expired}
+
+def build_fsm_storage():
+    if FSM_STORAGE_URL.startswith(("redis://", "rediss://")):
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(FSM_STORAGE_URL, state_ttl=int(FSM_TTL), data_ttl=int(FSM_TTL))
+    return BoundedMemoryStorage(FSM_MAX_KEYS, FSM_TTL)
+
+session_options = {"api": TelegramAPIServer.from_base(TELEGRAM_API_URL)} if TELEGRAM_API_URL else {}
+bot = Bot(token=BOT_TOKEN, session=PooledSession(HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_KEEPALIVE_TIMEOUT, **session_options))
+dp = Dispatcher(storage=build_fsm_storage())
+dp.update.outer_middleware(LogContextMiddleware())
+
+# Режим приёма апдейтов: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 4))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 10))
+# Многопроцессный режим: 0 — всё в одном процессе
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 0))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", 1000))
+SHARD_CONCURRENCY = int(os.getenv("SHARD_CONCURRENCY", 64))
+SHARD_PARK_SIZE = int(os.getenv("SHARD_PARK_SIZE", 10000))
+SHARD_CHECK_INTERVAL = float(os.getenv("SHARD_CHECK_INTERVAL", 0.1))
+# Как часто воркеры передают свои метрики и статистику в принимающий процесс
+SHARD_STATS_INTERVAL = float(os.getenv("SHARD_STATS_INTERVAL", 1))
+
+# Ограниченная очередь апдейтов между вебхуком и обработчиками
+update_queue: asyncio.Queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+background_tasks = set()
+polling_task: Optional[asyncio.Task] = None
+accepting_updates = True
 
 # =============================
 # FastAPI приложение для Render
@@ -37,15 +291,48 @@ dp = Dispatcher()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Запуск при старте
+    global shard_pool, polling_task, accepting_updates
     logger.info("🚀 Запуск бота...")
     
-    # Запускаем бота в фоне
-    asyncio.create_task(run_bot())
+    if WORKER_PROCESSES > 0:
+        shard_pool = ShardPool(WORKER_PROCESSES, SHARD_QUEUE_SIZE, SHARD_PARK_SIZE)
+        shard_pool.start()
+        spawn(shard_pool.supervise(SHARD_CHECK_INTERVAL))
+    if BOT_MODE == "webhook":
+        await start_webhook()
+    elif shard_pool is not None:
+        polling_task = spawn(run_sharded_polling())
+    else:
+        # Запускаем бота в фоне
+        polling_task = spawn(run_bot())
+    if CATALOG_WATCH_INTERVAL > 0:
+        spawn(watch_catalog())
+    lead_writer.start()
+    await user_registry.open()
+    if shard_pool is None:
+        spawn(broadcast_runner())
     
     yield
     
-    # Очистка при остановке
+    # Очистка при остановке: сначала перестаём принимать апдейты,
+    # затем в пределах SHUTDOWN_TIMEOUT дожидаемся начатых обработчиков
     logger.info("🛑 Остановка бота...")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_TIMEOUT
+    accepting_updates = False
+    if BOT_MODE == "webhook":
+        await stop_webhook(deadline)
+    else:
+        await stop_polling()
+    if shard_pool is not None:
+        await shard_pool.stop(max(0.0, deadline - loop.time()))
+    await in_flight.wait_idle(max(0.0, deadline - loop.time()))
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await lead_writer.stop(SHUTDOWN_TIMEOUT)
+    await user_registry.close()
+    await dp.storage.close()
     await bot.session.close()
 
 app = FastAPI(lifespan=lifespan)
@@ -58,35 +345,1135 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def process_stats():
+    # Состояние, которое каждый процесс ведёт сам; воркеры присылают его в принимающий процесс
+    return {
+        "send_scheduler": send_scheduler.stats(),
+        "edits": dict(edit_stats),
+        "leads": lead_writer.stats(),
+        "flood": flood_guard.stats(),
+        "logging": logging_stats(),
+        "fsm": dp.storage.stats() if isinstance(dp.storage, BoundedMemoryStorage) else {},
+    }
+
+@app.get("/stats")
+async def stats():
+    # В многопроцессном режиме верхний уровень — принимающий процесс, обработка — в "workers"
+    return {
+        **process_stats(),
+        "shards": shard_pool.stats() if shard_pool is not None else [],
+        "workers": [report and report[1] for report in shard_pool.reports] if shard_pool is not None else [],
+    }
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    if BOT_MODE != "webhook":
+        return Response(status_code=404)
+    # Без секрета вебхук не запускается, поэтому заголовок проверяется всегда
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return Response(status_code=403)
+    if not accepting_updates:
+        # Идёт остановка: Telegram доставит апдейт повторно
+        return Response(status_code=503)
+    if shard_pool is not None:
+        raw = await request.json()
+        if not shard_pool.put(raw):
+            logger.warning(f"Очередь шарда переполнена, апдейт {raw.get('update_id')} отклонён")
+            return Response(status_code=503)
+        return {"ok": True}
+    update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    try:
+        update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        # Telegram повторит доставку, если ответить не 200
+        logger.warning(f"Очередь апдейтов переполнена, апдейт {update.update_id} отклонён")
+        return Response(status_code=503)
+    return {"ok": True}
+
+# =============================
+# Фоновые задачи и обработка очереди апдейтов
+# =============================
+def spawn(coro):
+    # Держим ссылку на задачу, чтобы её не собрал GC
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def update_worker():
+    while True:
+        update = await update_queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            update_queue.task_done()
+
+async def start_webhook():
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL не задан для режима webhook")
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET не задан для режима webhook")
+    if shard_pool is None:
+        for _ in range(UPDATE_WORKERS):
+            spawn(update_worker())
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logger.info(f"✅ Вебхук установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+async def stop_webhook(deadline: float):
+    # Вебхук при остановке не удаляем: при перекрывающемся деплое он уже
+    # принадлежит новому экземпляру. Его снимает только переход на поллинг.
+    # Дожидаемся обработки уже принятых апдейтов
+    timeout = max(0.0, deadline - asyncio.get_running_loop().time())
+    try:
+        await asyncio.wait_for(update_queue.join(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Не обработано апдейтов при остановке: {update_queue.qsize()}")
+
+async def stop_polling():
+    if polling_task is None:
+        return
+    try:
+        await dp.stop_polling()
+    except RuntimeError:
+        # Поллинг сейчас не запущен (например, ждём перезапуска после сбоя)
+        pass
+    polling_task.cancel()
+    await asyncio.gather(polling_task, return_exceptions=True)
+
+class InFlightMiddleware(BaseMiddleware):
+    # Считает обработчики в работе, чтобы при остановке дождаться их завершения
+    def __init__(self):
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def __call__(self, handler, event, data):
+        self.active += 1
+        self.idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.active -= 1
+            if not self.active:
+                self.idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не завершено обработчиков при остановке: {self.active}")
+            return False
+        return True
+
+in_flight = InFlightMiddleware()
+dp.update.outer_middleware(in_flight)
+
+# =============================
+# МНОГОПРОЦЕССНЫЙ РЕЖИМ (шардирование по chat_id)
+# =============================
+# Один процесс принимает апдейты (поллинг или вебхук) и раскладывает их
+# по очередям WORKER_PROCESSES воркеров по chat_id. Каждый воркер держит
+# свой Dispatcher, апдейты одного чата обрабатываются строго по порядку.
+# Метрики и статистику воркеры раз в SHARD_STATS_INTERVAL отправляют
+# принимающему процессу, а он отдаёт их в /metrics (с меткой shard) и /stats.
+def update_chat_id(raw: dict) -> int:
+    for key, payload in raw.items():
+        if key == "update_id" or not isinstance(payload, dict):
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+    return raw.get("update_id", 0)
+
+class ShardPool:
+    def __init__(self, workers: int, queue_size: int, park_size: int = 10000):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.queue_size = queue_size
+        self.queues = [self.ctx.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processed = [self.ctx.Value("q", 0) for _ in range(workers)]
+        # Последний отчёт воркера: (снимок метрик, статистика процесса)
+        self.report_queues = [self.ctx.Queue(maxsize=2) for _ in range(workers)]
+        self.reports = [None] * workers
+        # Апдейты для шарда с полной очередью ждут здесь, не задерживая приём для остальных шардов
+        self.parked = [deque() for _ in range(workers)]
+        self.park_size = park_size
+        self.dropped = [0] * workers
+        self.restarts = [0] * workers
+        self.stopping = False
+        self.processes = [self._process(i) for i in range(workers)]
+
+    def _process(self, shard: int):
+        return self.ctx.Process(
+            target=shard_worker_main,
+            args=(shard, len(self.queues), self.queues[shard], self.processed[shard], self.report_queues[shard]),
+            name=f"shard-{shard}", daemon=True
+        )
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logger.info(f"🧩 Запущено воркеров: {len(self.processes)}")
+
+    def _flush(self, shard: int):
+        parked = self.parked[shard]
+        while parked:
+            try:
+                self.queues[shard].put_nowait(parked[0])
+            except queue.Full:
+                return
+            parked.popleft()
+
+    def put(self, raw: dict) -> bool:
+        # False — апдейт отброшен: заполнены и очередь шарда, и место для отложенных
+        shard = update_chat_id(raw) % len(self.queues)
+        self._flush(shard)
+        if not self.parked[shard]:
+            try:
+                self.queues[shard].put_nowait(raw)
+                return True
+            except queue.Full:
+                pass
+        if len(self.parked[shard]) >= self.park_size:
+            self.dropped[shard] += 1
+            return False
+        # Порядок внутри шарда сохраняется: пока есть отложенные, новые встают за ними
+        self.parked[shard].append(raw)
+        return True
+
+    def check(self):
+        # Перезапуск упавших воркеров и досылка отложенных апдейтов
+        for shard, process in enumerate(self.processes):
+            if not self.stopping and not process.is_alive():
+                logger.error(f"Воркер {process.name} завершился с кодом {process.exitcode}, перезапускаем")
+                # Упавший воркер мог унести блокировку чтения очереди — новый получает свежую,
+                # а апдейты из старой считаются потерянными
+                lost = self.queues[shard].qsize()
+                if lost:
+                    logger.warning(f"Шард {shard}: потеряно апдейтов из очереди упавшего воркера: {lost}")
+                    self.dropped[shard] += lost
+                self.queues[shard] = self.ctx.Queue(maxsize=self.queue_size)
+                self.report_queues[shard] = self.ctx.Queue(maxsize=2)
+                self.processes[shard] = self._process(shard)
+                self.processes[shard].start()
+                self.restarts[shard] += 1
+            self._flush(shard)
+            self._collect(shard)
+
+    def _collect(self, shard: int):
+        while True:
+            try:
+                self.reports[shard] = self.report_queues[shard].get_nowait()
+            except queue.Empty:
+                return
+
+    async def supervise(self, interval: float):
+        while not self.stopping:
+            self.check()
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return [
+            {
+                "shard": i, "queue_depth": q.qsize(), "parked": len(self.parked[i]), "processed": c.value,
+                "dropped": self.dropped[i], "restarts": self.restarts[i], "alive": p.is_alive(),
+            }
+            for i, (q, c, p) in enumerate(zip(self.queues, self.processed, self.processes))
+        ]
+
+    async def stop(self, timeout: float):
+        # Сигнал остановки идёт в конец очереди: воркер сначала доработает принятые апдейты
+        self.stopping = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        for shard, (shard_queue, process) in enumerate(zip(self.queues, self.processes)):
+            self._flush(shard)
+            if self.parked[shard]:
+                logger.warning(f"Шард {shard}: не передано апдейтов при остановке: {len(self.parked[shard])}")
+            if not process.is_alive():
+                continue
+            try:
+                await asyncio.to_thread(shard_queue.put, None, True, max(0.0, deadline - loop.time()))
+            except queue.Full:
+                pass
+        for process in self.processes:
+            await asyncio.to_thread(process.join, max(0.0, deadline - loop.time()))
+            if process.is_alive():
+                logger.warning(f"Воркер {process.name} не завершился вовремя, останавливаем принудительно")
+                process.terminate()
+        # Итоговые отчёты — только от воркеров, завершившихся штатно
+        for shard, process in enumerate(self.processes):
+            if process.exitcode == 0:
+                self._collect(shard)
+
+shard_pool: Optional[ShardPool] = None
+
+def shard_worker_main(shard_id: int, shards: int, shard_queue, processed, report_queue):
+    asyncio.run(shard_worker(shard_id, shards, shard_queue, processed, report_queue))
+    # Дочерний процесс завершается без atexit — дописываем лог явно
+    log_writer.stop()
+
+def send_report(report_queue):
+    # Принимающий процесс забирает отчёты каждые SHARD_CHECK_INTERVAL; не успел — ждём следующего
+    try:
+        report_queue.put_nowait((metrics.snapshot(), process_stats()))
+    except queue.Full:
+        pass
+
+async def report_loop(report_queue):
+    while True:
+        await asyncio.sleep(SHARD_STATS_INTERVAL)
+        send_report(report_queue)
+
+async def shard_worker(shard_id: int, shards: int, shard_queue, processed, report_queue):
+    # Глобальный лимит отправки делится между воркерами
+    send_scheduler.set_global_rate(SEND_GLOBAL_RATE / shards)
+    if CATALOG_WATCH_INTERVAL > 0:
+        spawn(watch_catalog())
+    lead_writer.start()
+    await user_registry.open()
+    if shard_id == 0:
+        # Рассылки выполняет только первый шард, в пределах его доли глобального лимита
+        spawn(broadcast_runner())
+    spawn(report_loop(report_queue))
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(SHARD_CONCURRENCY)
+    chains = {}
+    in_flight = set()
+
+    async def process(raw, previous):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await dp.feed_raw_update(bot, raw)
+        except Exception as e:
+            logger.error(f"Шард {shard_id}: ошибка обработки апдейта {raw.get('update_id')}: {e}")
+        finally:
+            with processed.get_lock():
+                processed.value += 1
+            semaphore.release()
+
+    def finished(task, chat_id):
+        in_flight.discard(task)
+        if chains.get(chat_id) is task:
+            del chains[chat_id]
+
+    while True:
+        raw = await loop.run_in_executor(None, shard_queue.get)
+        if raw is None:
+            break
+        await semaphore.acquire()
+        chat_id = update_chat_id(raw)
+        task = asyncio.create_task(process(raw, chains.get(chat_id)))
+        chains[chat_id] = task
+        in_flight.add(task)
+        task.add_done_callback(functools.partial(finished, chat_id=chat_id))
+
+    await asyncio.gather(*in_flight, return_exceptions=True)
+    await lead_writer.stop(SHUTDOWN_TIMEOUT)
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    send_report(report_queue)
+    await user_registry.close()
+    await dp.storage.close()
+    await bot.session.close()
+
+async def run_sharded_polling():
+    # Поллинг без локального Dispatcher: апдейты только раскладываются по шардам
+    allowed_updates = dp.resolve_used_update_types()
+    backoff = Backoff(polling_backoff)
+    webhook_removed = False
+    offset = None
+    while True:
+        try:
+            if not webhook_removed:
+                # Как и в run_bot: накопленные апдейты не сбрасываем, сбой сети — повод для повтора
+                await bot.delete_webhook()
+                webhook_removed = True
+            updates = await bot.get_updates(
+                offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates,
+                request_timeout=POLLING_TIMEOUT + 10,
+            )
+        except Exception as e:
+            delay = next(backoff)
+            logger.error(f"❌ Ошибка получения апдейтов: {e}")
+            logger.info(f"🔄 Повтор через {delay:.1f} секунд...")
+            await asyncio.sleep(delay)
+            continue
+        backoff.reset()
+        for update in updates:
+            raw = update.model_dump(mode="json", exclude_none=True, by_alias=True)
+            if not shard_pool.put(raw):
+                logger.error(f"Шард переполнен, апдейт {update.update_id} отброшен")
+            offset = update.update_id + 1
+
+# =============================
+# ПЛАНИРОВЩИК ИСХОДЯЩИХ ЗАПРОСОВ
+# =============================
+# Все вызовы Bot API проходят через middleware сессии: новые сообщения
+# ограничены глобально (~30/с) и на чат, правки — только своим лимитом на чат,
+# ответы на callback идут мимо лимитов и очередей. TelegramRetryAfter
+# повторяется через указанное сервером время; ответ на нажатие — только
+# если ждать недолго, иначе Telegram всё равно отклонит устаревший запрос.
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", 5))
+# Правки не расходуют глобальный лимит сообщений, у них своя, более мягкая початовая корзина
+SEND_EDIT_RATE = float(os.getenv("SEND_EDIT_RATE", 3))
+SEND_EDIT_BURST = float(os.getenv("SEND_EDIT_BURST", 10))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 3))
+SEND_ANSWER_MAX_WAIT = float(os.getenv("SEND_ANSWER_MAX_WAIT", 1))
+
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = 1
+
+# Позволяет фоновым задачам (рассылкам) понизить приоритет своих запросов
+send_priority: ContextVar[Optional[int]] = ContextVar("send_priority", default=None)
+
+# Метод -> (приоритет, лимит): "message" — глобальная и початовая корзины
+# сообщений, "edit" — початовая корзина правок, None — без ожидания и
+# очереди (ответ на нажатие должен уйти сразу), только короткий повтор
+THROTTLED_METHODS = {
+    methods.AnswerCallbackQuery: (None, None),
+    methods.SendMessage: (PRIORITY_NORMAL, "message"),
+    methods.EditMessageText: (PRIORITY_NORMAL, "edit"),
+    methods.EditMessageReplyMarkup: (PRIORITY_NORMAL, "edit"),
+}
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        # Через сколько секунд будет доступен один токен
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def consume(self):
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        return now - self.updated >= self.capacity / self.rate and now >= self.blocked_until
+
+class SendScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, edit_rate: float, edit_burst: float, max_retries: int):
+        self.global_rate = global_rate
+        self.chat_limits = {"message": (chat_rate, chat_burst), "edit": (edit_rate, edit_burst)}
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1.0), 0.0)
+        self.chat_buckets = {}
+        self.pending = {PRIORITY_NORMAL: 0, PRIORITY_LOW: 0}
+        self.sent = 0
+        self.retries = 0
+        self.answers_dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.acquired = 0
+
+    def set_global_rate(self, rate: float):
+        self.global_rate = rate
+        self.global_bucket = TokenBucket(rate, max(rate, 1.0), 0.0)
+
+    def _chat_bucket(self, limit: str, chat_id, now: float):
+        bucket = self.chat_buckets.get((limit, chat_id))
+        if bucket is None:
+            bucket = self.chat_buckets[(limit, chat_id)] = TokenBucket(*self.chat_limits[limit], now)
+        return bucket
+
+    def _prune(self, now: float):
+        # Полные и давно неиспользуемые корзины не нужны: память не растёт с числом чатов
+        for key in [k for k, b in self.chat_buckets.items() if b.idle(now)]:
+            del self.chat_buckets[key]
+
+    async def acquire(self, priority: int, chat_id=None, limit: str = "message"):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        self.pending[priority] += 1
+        try:
+            while True:
+                now = loop.time()
+                global_bucket = self.global_bucket if limit == "message" else None
+                wait = global_bucket.delay(now) if global_bucket is not None else 0.0
+                chat_bucket = self._chat_bucket(limit, chat_id, now) if chat_id is not None else None
+                if chat_bucket is not None:
+                    wait = max(wait, chat_bucket.delay(now))
+                if global_bucket is not None and any(self.pending[p] for p in range(priority)):
+                    # Уступаем более приоритетным запросам, ожидающим токен
+                    wait = max(wait, 1 / self.global_rate)
+                if wait <= 0:
+                    if global_bucket is not None:
+                        global_bucket.consume()
+                    if chat_bucket is not None:
+                        chat_bucket.consume()
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            self.pending[priority] -= 1
+        waited = loop.time() - started
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.acquired += 1
+        if self.acquired % 1000 == 0:
+            self._prune(loop.time())
+
+    def block(self, limit: str, chat_id, retry_after: float):
+        # Сервер попросил подождать: до этого момента в чат (или глобально) не отправляем
+        now = asyncio.get_running_loop().time()
+        bucket = self._chat_bucket(limit, chat_id, now) if chat_id is not None else self.global_bucket
+        bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+
+    async def __call__(self, make_request, bot, method):
+        spec = THROTTLED_METHODS.get(type(method))
+        if spec is None:
+            return await make_request(bot, method)
+        priority, limit = spec
+        priority = send_priority.get() if send_priority.get() is not None else priority
+        chat_id = getattr(method, "chat_id", None)
+        attempt = 0
+        while True:
+            if limit is not None:
+                await self.acquire(priority, chat_id, limit)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if limit is None and (attempt >= self.max_retries or e.retry_after > SEND_ANSWER_MAX_WAIT):
+                    # Ответ на нажатие не держит обработчик: индикатор на кнопке погаснет сам
+                    self.answers_dropped += 1
+                    logger.warning(f"Flood control: {type(method).__name__} не отправлен, ожидание {e.retry_after} с")
+                    return False
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"Flood control: {type(method).__name__}, повтор через {e.retry_after} с")
+                if limit is None:
+                    await asyncio.sleep(e.retry_after)
+                else:
+                    self.block(limit, chat_id, e.retry_after)
+                continue
+            self.sent += 1
+            return response
+
+    def stats(self):
+        return {
+            "queue_depth": {
+                "normal": self.pending[PRIORITY_NORMAL],
+                "low": self.pending[PRIORITY_LOW],
+            },
+            "sent": self.sent,
+            "retries": self.retries,
+            "answers_dropped": self.answers_dropped,
+            "wait_avg": self.wait_total / self.acquired if self.acquired else 0.0,
+            "wait_max": self.wait_max,
+            "chat_buckets": len(self.chat_buckets),
+        }
+
+send_scheduler = SendScheduler(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_EDIT_RATE, SEND_EDIT_BURST, SEND_MAX_RETRIES)
+bot.session.middleware(send_scheduler)
+
+# =============================
+# МЕТРИКИ
+# =============================
+# Гистограммы задержек обработчиков и вызовов Bot API, счётчики ошибок
+# и апдейтов. Отдаются в текстовом формате Prometheus на /metrics; в
+# многопроцессном режиме к ним добавляются снимки воркеров с меткой shard.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self):
+        self.handler_latency = {}
+        self.api_latency = {}
+        self.errors = {}
+        self.updates = {}
+
+    def observe_handler(self, name: str, seconds: float):
+        histogram = self.handler_latency.get(name)
+        if histogram is None:
+            histogram = self.handler_latency[name] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_api(self, method: str, seconds: float):
+        histogram = self.api_latency.get(method)
+        if histogram is None:
+            histogram = self.api_latency[method] = Histogram()
+        histogram.observe(seconds)
+
+    def count_error(self, source: str, error: BaseException):
+        key = (source, type(error).__name__)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def count_update(self, update_type: str):
+        self.updates[update_type] = self.updates.get(update_type, 0) + 1
+
+    def snapshot(self):
+        # Всё, что копится в этом процессе, в виде, пригодном для передачи между процессами
+        return {
+            "updates": dict(self.updates),
+            "handler_latency": {name: (list(h.counts), h.sum, h.count) for name, h in self.handler_latency.items()},
+            "api_latency": {name: (list(h.counts), h.sum, h.count) for name, h in self.api_latency.items()},
+            "errors": dict(self.errors),
+            "edits": dict(edit_stats),
+            "flood": dict(flood_guard.counters),
+            "log_dropped": log_handler.dropped,
+            "log_sampled_out": log_handler.filters[0].skipped,
+            "send_queue_depth": send_scheduler.stats()["queue_depth"],
+        }
+
+    @staticmethod
+    def _labels(*pairs):
+        pairs = [pair for pair in pairs if pair]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @classmethod
+    def _histogram_lines(cls, name: str, label: str, sources, field: str):
+        lines = [f"# TYPE {name} histogram"]
+        for shard, snapshot in sources:
+            for value, (counts, total, count) in sorted(snapshot[field].items()):
+                series = f'{label}="{value}"'
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                    cumulative += bucket
+                    le = f'le="{bound}"'
+                    lines.append(f"{name}_bucket{cls._labels(shard, series, le)} {cumulative}")
+                lines.append(f"{name}_sum{cls._labels(shard, series)} {total}")
+                lines.append(f"{name}_count{cls._labels(shard, series)} {count}")
+        return lines
+
+    @classmethod
+    def _counter_lines(cls, name: str, kind: str, label: str, sources, field: str):
+        lines = [f"# TYPE {name} {kind}"]
+        for shard, snapshot in sources:
+            for value, count in sorted(snapshot[field].items()):
+                series = f'{label}="{value}"'
+                lines.append(f"{name}{cls._labels(shard, series)} {count}")
+        return lines
+
+    def render(self) -> str:
+        # Метрики этого процесса — без метки, снимки воркеров — с меткой shard
+        sources = [("", self.snapshot())]
+        if shard_pool is not None:
+            sources += [
+                (f'shard="{shard}"', report[0]) for shard, report in enumerate(shard_pool.reports) if report is not None
+            ]
+        lines = self._counter_lines("bot_updates_total", "counter", "type", sources, "updates")
+        lines += self._histogram_lines("bot_handler_duration_seconds", "handler", sources, "handler_latency")
+        lines += self._histogram_lines("bot_api_request_duration_seconds", "method", sources, "api_latency")
+        lines.append("# TYPE bot_errors_total counter")
+        for shard, snapshot in sources:
+            for (source, error), count in sorted(snapshot["errors"].items()):
+                series = f'source="{source}",type="{error}"'
+                lines.append(f"bot_errors_total{self._labels(shard, series)} {count}")
+        lines += self._counter_lines("bot_edits_total", "counter", "result", sources, "edits")
+        lines.append("# TYPE bot_log_records_dropped_total counter")
+        lines += [f"bot_log_records_dropped_total{self._labels(shard)} {snapshot['log_dropped']}" for shard, snapshot in sources]
+        lines.append("# TYPE bot_log_records_sampled_out_total counter")
+        lines += [f"bot_log_records_sampled_out_total{self._labels(shard)} {snapshot['log_sampled_out']}" for shard, snapshot in sources]
+        lines += self._counter_lines("bot_flood_updates_total", "counter", "result", sources, "flood")
+        if shard_pool is not None:
+            lines.append("# TYPE bot_shard_queue_depth gauge")
+            shards = shard_pool.stats()
+            for shard in shards:
+                lines.append(f'bot_shard_queue_depth{{shard="{shard["shard"]}"}} {shard["queue_depth"]}')
+            lines.append("# TYPE bot_shard_parked gauge")
+            for shard in shards:
+                lines.append(f'bot_shard_parked{{shard="{shard["shard"]}"}} {shard["parked"]}')
+            lines.append("# TYPE bot_shard_dropped_total counter")
+            for shard in shards:
+                lines.append(f'bot_shard_dropped_total{{shard="{shard["shard"]}"}} {shard["dropped"]}')
+            lines.append("# TYPE bot_shard_restarts_total counter")
+            for shard in shards:
+                lines.append(f'bot_shard_restarts_total{{shard="{shard["shard"]}"}} {shard["restarts"]}')
+        lines += self._counter_lines("bot_send_queue_depth", "gauge", "priority", sources, "send_queue_depth")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    # Внешний middleware апдейтов: пропускная способность и необработанные ошибки
+    async def __call__(self, handler, event: types.Update, data):
+        metrics.count_update(event.event_type)
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.count_error("handler", e)
+            raise
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: задержка конкретного обработчика
+    async def __call__(self, handler, event, data):
+        callback = data["handler"].callback
+        if callback is route_callback:
+            callback = CALLBACK_ROUTES.get(data["callback_action"], callback)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            duration = time.perf_counter() - started
+            metrics.observe_handler(callback.__name__, duration)
+            logger.info("update handled", extra={"handler": callback.__name__, "duration_ms": round(duration * 1000, 2), "sampled": True})
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    # Регистрируется после планировщика, поэтому меряет сам запрос без ожидания лимитов
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.count_error("api", e)
+            raise
+        finally:
+            metrics.observe_api(type(method).__name__, time.perf_counter() - started)
+
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+for observer in (dp.message, dp.callback_query, dp.inline_query):
+    observer.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(ApiMetricsMiddleware())
+
+# =============================
+# ЗАЩИТА ОТ ФЛУДА
+# =============================
+# Внешний middleware апдейтов отсекает лишнее до обработчиков: повторное
+# нажатие той же кнопки того же сообщения в течение FLOOD_DUPLICATE_WINDOW
+# (на него только отвечаем, без правки) и всё сверх FLOOD_RATE апдейтов
+# от пользователя за FLOOD_RATE_WINDOW секунд (0 отключает соответствующую
+# проверку). Записи пользователей лежат в порядке последней активности
+# и удаляются, как только окна истекли.
+FLOOD_RATE = int(os.getenv("FLOOD_RATE", 5))
+FLOOD_RATE_WINDOW = float(os.getenv("FLOOD_RATE_WINDOW", 1))
+FLOOD_DUPLICATE_WINDOW = float(os.getenv("FLOOD_DUPLICATE_WINDOW", 1))
+
+class FloodGuardMiddleware(BaseMiddleware):
+    def __init__(self, rate: int, window: float, duplicate_window: float):
+        self.rate = rate
+        self.window = window
+        self.duplicate_window = duplicate_window
+        self.idle = max(window, duplicate_window)
+        # user_id -> [времена пропущенных апдейтов, последняя кнопка, время её нажатия, последняя активность]
+        self.users = OrderedDict()
+        self.counters = {"passed": 0, "duplicate": 0, "rate": 0}
+
+    def _reclaim(self, now: float):
+        while self.users:
+            record = next(iter(self.users.values()))
+            if now - record[3] < self.idle:
+                break
+            self.users.popitem(last=False)
+
+    async def __call__(self, handler, event: types.Update, data):
+        user = data.get("event_from_user")
+        if user is None or (self.rate <= 0 and self.duplicate_window <= 0):
+            return await handler(event, data)
+        now = time.monotonic()
+        self._reclaim(now)
+        record = self.users.get(user.id)
+        if record is None:
+            record = self.users[user.id] = [deque(), None, 0.0, now]
+        else:
+            record[3] = now
+            self.users.move_to_end(user.id)
+        callback = event.callback_query
+        button = None
+        if callback is not None:
+            target = callback.message.message_id if callback.message else callback.inline_message_id
+            button = (target, callback.data)
+            if button == record[1] and now - record[2] < self.duplicate_window:
+                self.counters["duplicate"] += 1
+                await callback.answer()
+                return None
+        # Поиск по мере ввода шлёт inline-запрос на каждую букву: отброшенный последний
+        # запрос оставил бы на экране результаты для устаревшего префикса
+        if self.rate > 0 and event.inline_query is None:
+            hits = record[0]
+            while hits and now - hits[0] >= self.window:
+                hits.popleft()
+            if len(hits) >= self.rate:
+                self.counters["rate"] += 1
+                # Неотвеченное нажатие крутит индикатор загрузки на кнопке
+                if callback is not None:
+                    await callback.answer()
+                return None
+            hits.append(now)
+        if button is not None:
+            record[1], record[2] = button, now
+        self.counters["passed"] += 1
+        return await handler(event, data)
+
+    def stats(self):
+        return {**self.counters, "users": len(self.users)}
+
+flood_guard = FloodGuardMiddleware(FLOOD_RATE, FLOOD_RATE_WINDOW, FLOOD_DUPLICATE_WINDOW)
+dp.update.outer_middleware(flood_guard)
+
 # =============================
 # Безопасное редактирование
 # =============================
-async def safe_edit_message(message: types.Message, text: str, reply_markup=None, parse_mode="Markdown"):
+# Для каждого сообщения помним хэш последнего отправленного содержимого
+# (LRU), чтобы не слать неизменившиеся правки. Пока правка сообщения в пути,
+# новые правки не сравниваются с устаревшим кэшем, а встают следом за ней;
+# из нескольких ожидающих уходит только последняя.
+EDIT_CACHE_SIZE = int(os.getenv("EDIT_CACHE_SIZE", 10000))
+
+last_edits = OrderedDict()
+# (chat_id, message_id) -> [следующая правка или None] для сообщений, правка которых в пути
+inflight_edits = {}
+edit_stats = {"sent": 0, "skipped": 0, "coalesced": 0, "not_modified": 0, "not_found": 0, "failed": 0}
+
+def edit_digest(text: str, reply_markup, parse_mode) -> int:
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup is not None else None
+    return hash((text, markup, parse_mode))
+
+def remember_edit(key, digest: int):
+    last_edits[key] = digest
+    last_edits.move_to_end(key)
+    if len(last_edits) > EDIT_CACHE_SIZE:
+        last_edits.popitem(last=False)
+
+async def safe_edit_message(message: types.Message, text: str, reply_markup=None, parse_mode="Markdown") -> bool:
+    # False — только если редактировать больше нечего (сообщение удалено или недоступно)
+    key = (message.chat.id, message.message_id)
+    edit = (text, reply_markup, parse_mode, edit_digest(text, reply_markup, parse_mode))
+    queued = inflight_edits.get(key)
+    if queued is not None:
+        if queued[0] is not None:
+            edit_stats["coalesced"] += 1
+        queued[0] = edit
+        return True
+    queued = inflight_edits[key] = [None]
+    try:
+        while edit is not None:
+            if last_edits.get(key) == edit[3]:
+                last_edits.move_to_end(key)
+                edit_stats["skipped"] += 1
+            elif not await send_edit(message, key, edit):
+                # Сообщения больше нет — ожидающие правки отправлять некуда
+                return False
+            edit, queued[0] = queued[0], None
+    finally:
+        del inflight_edits[key]
+    return True
+
+async def send_edit(message: types.Message, key, edit) -> bool:
+    text, reply_markup, parse_mode, digest = edit
     try:
         await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        edit_stats["sent"] += 1
+        remember_edit(key, digest)
     except TelegramBadRequest as e:
         if "message is not modified" in e.message:
-            pass
-        elif "message to edit not found" in e.message:
+            edit_stats["not_modified"] += 1
+            remember_edit(key, digest)
+        elif "message to edit not found" in e.message or "message can't be edited" in e.message:
+            edit_stats["not_found"] += 1
+            last_edits.pop(key, None)
             logger.warning("Сообщение для редактирования не найдено")
+            return False
         else:
+            edit_stats["failed"] += 1
+            last_edits.pop(key, None)
             logger.error(f"Ошибка редактирования: {e}")
+    except TelegramRetryAfter as e:
+        edit_stats["failed"] += 1
+        last_edits.pop(key, None)
+        logger.error(f"Редактирование не выполнено из-за flood control: {e.retry_after} с")
     except Exception as e:
+        edit_stats["failed"] += 1
+        last_edits.pop(key, None)
         logger.error(f"Неожиданная ошибка: {e}")
+    return True
 
 # =============================
-# ВАШ ОСНОВНОЙ КОД БОТА (без изменений)
+# МАРШРУТИЗАЦИЯ CALLBACK-ЗАПРОСОВ
 # =============================
+# callback_data вида "action:argument" разбирается один раз, обработчик
+# выбирается по action из словаря, порядок регистрации не важен
+CALLBACK_ROUTES = {}
 
-@dp.message(Command("start"))
-async def start(message: types.Message):
-    logger.info(f"Пользователь {message.from_user.id} запустил бота")
+def callback_route(action: str):
+    def decorator(handler):
+        if action in CALLBACK_ROUTES:
+            raise ValueError(f"Маршрут {action!r} уже зарегистрирован")
+        CALLBACK_ROUTES[action] = handler
+        return handler
+    return decorator
+
+def parse_callback(data: str):
+    action, _, argument = data.partition(":")
+    return action, argument
+
+# Компактный формат callback_data (лимит Telegram — 64 байта):
+# <версия><код действия><поля через ".">, например "2k1r" вместо
+# "svc_show:urgent_bankrot". Позиции каталога передаются своим постоянным
+# id из catalog.json (base36), разделы — кодом, страница — последним полем.
+# Строки без цифры версии — прежний формат "action:argument", поэтому кнопки
+# в ранее отправленных сообщениях продолжают работать.
+CALLBACK_VERSION = "2"
+CALLBACK_DATA_LIMIT = 64
+BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# action -> (код действия, вид аргумента); ref — ключ позиции как аргумент другого действия
+CALLBACK_ACTIONS = {
+    "back_to_main": ("a", "screen"),
+    "ecp_main": ("b", "screen"),
+    "ecp_type": ("c", "section"),
+    "ecp_show": ("d", "item"),
+    "crypto_main": ("e", "screen"),
+    "crypto_show": ("f", "item"),
+    "services_main": ("g", "screen"),
+    "proc": ("h", "section"),
+    "struct_menu": ("i", "screen"),
+    "svc": ("j", "section"),
+    "svc_show": ("k", "item"),
+    "lead": ("l", "lead"),
+    "lead_send": ("m", "lead"),
+    "quote": ("n", "screen"),
+    "quote_add": ("o", "ref"),
+    "quote_del": ("p", "ref"),
+    "quote_clear": ("q", "screen"),
+    "quote_send": ("r", "screen"),
+}
+CALLBACK_CODES = {code: (action, kind) for action, (code, kind) in CALLBACK_ACTIONS.items()}
+
+def to_base36(n: int) -> str:
+    digits = ""
+    while True:
+        n, r = divmod(n, 36)
+        digits = BASE36[r] + digits
+        if not n:
+            return digits
+
+def encode_callback(catalog, key: str) -> str:
+    # Канонический ключ экрана ("ecp_show:ftp", "ecp_type:fl#1", "lead:3:svc_show:x") -> callback_data
+    action, _, argument = key.partition(":")
+    spec = CALLBACK_ACTIONS.get(action)
+    if spec is None:
+        data = key
+    else:
+        code, kind = spec
+        if kind == "item":
+            fields = [to_base36(catalog.item_ids[key])]
+        elif kind == "ref":
+            fields = [to_base36(catalog.item_ids[argument])]
+        elif kind == "lead":
+            mask, item = parse_lead(argument)
+            fields = [to_base36(catalog.item_ids[item])] + ([to_base36(mask)] if mask else [])
+        elif kind == "section":
+            fields = argument.split("#")
+        else:
+            fields = []
+        data = CALLBACK_VERSION + code + ".".join(fields)
+    if len(data.encode()) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data!r}")
+    return data
+
+def decode_callback(catalog, data: str):
+    # Разбор нажатия: callback_data -> (action, argument) в каноническом виде.
+    # Кнопки каталога находятся в готовой таблице, разбор нужен только остальным
+    decoded = catalog.callbacks.get(data)
+    if decoded is not None:
+        return decoded
+    if not data[:1].isdigit():
+        return parse_callback(data)
+    if data[0] != CALLBACK_VERSION:
+        return "", ""
+    action, kind = CALLBACK_CODES.get(data[1:2], ("", ""))
+    fields = data[2:].split(".")
+    try:
+        if kind == "item":
+            key = catalog.item_keys.get(int(fields[0], 36))
+            # Позиция удалена из каталога — обработчик ответит «не найдено»
+            return parse_callback(key) if key else (action, "")
+        if kind == "ref":
+            return action, catalog.item_keys.get(int(fields[0], 36), "")
+        if kind == "lead":
+            key = catalog.item_keys.get(int(fields[0], 36), "")
+            mask = int(fields[1], 36) if len(fields) > 1 else 0
+            return action, f"{mask}:{key}"
+    except ValueError:
+        return "", ""
+    if kind == "section":
+        return action, "#".join(fields)
+    return action, ""
+
+def build_callbacks(catalog):
+    # Все экраны каталога и действия без аргумента, а также добавление в расчёт
+    # и заявка без опций для каждой позиции
+    keys = list(catalog.screens)
+    for action, (_, kind) in CALLBACK_ACTIONS.items():
+        if kind == "screen":
+            keys.append(action)
+        elif kind == "ref":
+            keys.extend(f"{action}:{item}" for item in catalog.item_ids)
+        elif kind == "lead":
+            keys.extend(f"{action}:0:{item}" for item in catalog.item_ids)
+    callbacks = {}
+    for key in keys:
+        data = encode_callback(catalog, key)
+        callbacks[data] = decode_callback(catalog, data)
+        # Прежний формат "action:argument" совпадает с ключом экрана
+        callbacks[key] = parse_callback(key)
+    return callbacks
+
+def callback_key(catalog, data: str) -> str:
+    # Ключ экрана в реестре, на который ведёт кнопка
+    action, argument = decode_callback(catalog, data)
+    return f"{action}:{argument}" if argument else action
+
+class CallbackDataMiddleware(BaseMiddleware):
+    # callback_data разбирается один раз на нажатие: маршрутизатор и метрики берут результат из data
+    async def __call__(self, handler, event: types.CallbackQuery, data):
+        data["callback_action"], data["callback_argument"] = decode_callback(CATALOG, event.data or "")
+        return await handler(event, data)
+
+dp.callback_query.outer_middleware(CallbackDataMiddleware())
+
+@dp.callback_query()
+async def route_callback(callback: types.CallbackQuery, callback_action: str, callback_argument: str):
+    handler = CALLBACK_ROUTES.get(callback_action)
+    if handler is None:
+        logger.warning(f"Неизвестный callback: {callback.data}")
+        await callback.answer()
+        return
+    await handler(callback, callback_argument)
+
+# =============================
+# РЕЕСТР ЭКРАНОВ
+# =============================
+# Все статические экраны рендерятся один раз при загрузке каталога:
+# ключ экрана ("action:argument", у страниц списка — "action:раздел#N")
+# -> (text, reply_markup, parse_mode)
+MENU_PAGE_SIZE = int(os.getenv("MENU_PAGE_SIZE", 8))
+
+class Screen(NamedTuple):
+    text: str
+    reply_markup: Optional[InlineKeyboardMarkup]
+    parse_mode: Optional[str] = "Markdown"
+
+async def show_screen(callback: types.CallbackQuery, key: str, not_found: str = "Раздел не найден"):
+    screen = CATALOG.screens.get(key)
+    if screen is None:
+        await callback.answer(not_found, show_alert=True)
+        return
+    await navigate(callback, screen)
+    await callback.answer()
+
+async def navigate(callback: types.CallbackQuery, screen: Screen):
+    # Экран всегда правится на месте; новое сообщение уходит, только если
+    # исходное удалено или уже недоступно боту
+    message = callback.message
+    if isinstance(message, types.Message) and await safe_edit_message(
+        message, screen.text, reply_markup=screen.reply_markup, parse_mode=screen.parse_mode
+    ):
+        return
+    chat_id = message.chat.id if message is not None else callback.from_user.id
+    await callback.bot.send_message(chat_id, screen.text, reply_markup=screen.reply_markup, parse_mode=screen.parse_mode)
+
+def section_key(action: str, section: str, page: int = 0) -> str:
+    return f"{action}:{section}#{page}" if page else f"{action}:{section}"
+
+def page_count(items) -> int:
+    return max(1, -(-len(items) // MENU_PAGE_SIZE))
+
+def page_items(items, page: int):
+    return items[page * MENU_PAGE_SIZE:(page + 1) * MENU_PAGE_SIZE]
+
+def item_page(items, code: str) -> int:
+    # Страница списка, на которой стоит позиция, — туда ведёт «Назад» из карточки
+    return [item[0] for item in items].index(code) // MENU_PAGE_SIZE
+
+def build_screen_tree(catalog):
+    # Ключ экрана -> ключ родителя. Дерево строится по разделам каталога,
+    # из него берутся все кнопки «Назад»; карточка ведёт на страницу списка,
+    # где стоит позиция, форма заявки (узел без опций, "lead:0:<позиция>") — на карточку.
+    parents = {"ecp_main": "back_to_main", "crypto_main": "back_to_main", "services_main": "back_to_main", "quote": "back_to_main"}
+    for sections, list_action, item_action, parent in (
+        (catalog.ecps_data, "ecp_type", "ecp_show", "ecp_main"),
+        (catalog.procurements, "proc", "svc_show", "services_main"),
+        (catalog.other_services, "svc", "svc_show", "services_main"),
+    ):
+        for section, items in sections.items():
+            for page in range(page_count(items)):
+                parents[section_key(list_action, section, page)] = parent
+            for code, name, desc, price in items:
+                parents[f"{item_action}:{code}"] = section_key(list_action, section, item_page(items, code))
+                if code == "struct_menu":
+                    parents["struct_menu"] = parents[f"{item_action}:{code}"]
+    for code, name, desc, price in catalog.crypto_items:
+        parents[f"crypto_show:{code}"] = "crypto_main"
+    for code, name, desc, price in catalog.structure_items:
+        parents[f"svc_show:{code}"] = "struct_menu"
+    for key in catalog.item_ids:
+        parents[f"lead:0:{key}"] = key
+    return parents
+
+def back_button(catalog, key: str, text: str = "← Назад"):
+    return InlineKeyboardButton(text=text, callback_data=encode_callback(catalog, catalog.parents[key]))
+
+def render_section(catalog, builder: InlineKeyboardBuilder, action: str, section: str, page: int, pages: int):
+    # Позиции по одной в ряд, затем «◀️ N/M ▶️» и «Назад»
+    builder.adjust(1)
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text="◀️", callback_data=encode_callback(catalog, section_key(action, section, page - 1))))
+        nav.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=encode_callback(catalog, section_key(action, section, page))))
+        if page + 1 < pages:
+            nav.append(InlineKeyboardButton(text="▶️", callback_data=encode_callback(catalog, section_key(action, section, page + 1))))
+        builder.row(*nav)
+    builder.row(back_button(catalog, section_key(action, section, page)))
+    return builder.as_markup()
+
+def render_main(catalog):
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="ЭЦП", callback_data="ecp_main")],
-        [InlineKeyboardButton(text="Все для ЭЦП", callback_data="crypto_main")],
-        [InlineKeyboardButton(text="Услуги по закупкам", callback_data="services_main")]
+        [InlineKeyboardButton(text="ЭЦП", callback_data=encode_callback(catalog, "ecp_main"))],
+        [InlineKeyboardButton(text="Все для ЭЦП", callback_data=encode_callback(catalog, "crypto_main"))],
+        [InlineKeyboardButton(text="Услуги по закупкам", callback_data=encode_callback(catalog, "services_main"))],
+        [InlineKeyboardButton(text="🧮 Расчёт стоимости", callback_data=encode_callback(catalog, "quote"))]
     ])
-    await message.answer("Выберите раздел:", reply_markup=kb)
+    return Screen("Выберите раздел:", kb, None)
+
+@dp.message(Command("start"))
+async def start(message: types.Message, command: Optional[CommandObject] = None):
+    logger.info(f"Пользователь {message.from_user.id} запустил бота", extra={"sampled": True})
+    screens = CATALOG.screens
+    # Ссылка вида t.me/<бот>?start=ecp_show-ftp открывает нужный экран
+    key = command.args.replace("-", ":", 1) if command and command.args else "back_to_main"
+    screen = screens.get(key, screens["back_to_main"])
+    await message.answer(screen.text, reply_markup=screen.reply_markup, parse_mode=screen.parse_mode)
 
 @dp.message(Command("help"))
 async def help_command(message: types.Message):
@@ -95,11 +1482,13 @@ async def help_command(message: types.Message):
 /start - Главное меню
 /help - Справка по боту
 /status - Проверка работоспособности
+/search <запрос> - Поиск по услугам и ценам
 
 🔍 **Разделы бота:**
 1. ЭЦП - Выпуск электронных подписей для различных площадок
 2. Все для ЭЦП - Ключи, лицензии и настройка
 3. Услуги по закупкам - Сопровождение торгов
+4. Расчёт стоимости - Итог по нескольким услугам сразу
 
 📞 **Техподдержка:**
 Если возникли проблемы, обратитесь к администратору.
@@ -113,336 +1502,1148 @@ async def status_command(message: types.Message):
 # =============================
 # БЛОК 1: ЭЦП (выпуск под площадки)
 # =============================
-ECPS_DATA = {
-    "fl": [
-        ("ftp", "ФТП", "Федеральные торговые площадки", "2800"),
-        ("rosreestr_fl", "Росреестр (ФЛ)", "Для покупки квартиры", "2100"),
-        ("epgu", "ЕПГУ", "Госуслуги и государственные порталы", "2100"),
-        ("efrsfdyul", "ЕФРСФДЮЛ", "Федеральный ресурс юридических лиц", "2100"),
-        ("fts", "ФТС", "Таможенная служба", "2100"),
-        ("fts_alta", "ФТС Альта-Софт", "Таможня + программное обеспечение Альта-Софт", "4100"),
-        ("egais", "ЕГАИС", "Учёт оборота алкогольной продукции", "2300"),
-        ("rosreestr_ki", "Росреестр (кадастровый инженер)", "Подписание межевых и техпланов", "2100"),
-        ("rosreestr_au", "Росреестр (арбитражный управляющий)", "Работа с делами о банкротстве", "2100"),
-        ("rzd", "РЖД", "Электронная торговая площадка ОАО «РЖД»", "3300"),
-        ("cdt", "ЦДТ", "Центр дистанционных торгов", "6800"),
-        ("utender", "uTender", "Коммерческая ЭТП", "4600"),
-        ("fabrikant", "Фабрикант", "Коммерческая ЭТП", "4000"),
-        ("b2b", "B2B-Center", "Крупнейшая коммерческая площадка", "4000"),
-        ("regtorg", "Регторг", "Коммерческая площадка", "4400"),
-        ("uetp", "УЭТП", "Уральская ЭТП", "4400"),
-        ("aist", "АИСТ", "Коммерческая ЭТП", "4600"),
-        ("tender_ug", "Тендер ug", "Коммерческая площадка", "4800"),
-        ("gpb", "ГПБ", "Закупки Газпромбанка", "5000"),
-        ("alfalot", "Альфалот", "Коммерческая площадка", "4300"),
-        ("atc", "Аукц. тендерный центр", "Коммерческая площадка", "3700"),
-        ("center_real", "Центр реализации", "Продажа имущества (в т.ч. банкротство)", "2900"),
-        ("etp_esp", "ЭТП ЭСП", "Поволжская площадка", "2900"),
-        ("fis_frd", "ФИС ФРДО", "Для образовательных учреждений всех уровней", "2900"),
-        ("crypto_embed", "Вшитая лицензия Крипто Про", "Дополнительно к ЭЦП", "+900"),
-    ],
-    "ip": [
-        ("ip_note", "ИП", "Не выпускаем новые ЭЦП на ИП. Возможна только продление по действующей.", "1500"),
-    ],
-    "ul": [
-        ("ul_note", "ООО / ЮЛ", "Не выпускаем новые ЭЦП на ООО. Возможна только продление по действующей.", "1500"),
-    ]
-}
-
-ECPS_INFO = {}
-for ecp_type in ECPS_DATA:
-    for code, name, desc, price in ECPS_DATA[ecp_type]:
-        ECPS_INFO[code] = {"name": name, "desc": desc, "price": price, "type": ecp_type}
+ECP_TITLES = {"fl": "Физическое лицо", "ip": "ИП", "ul": "ООО / Юридическое лицо"}
 
-@dp.callback_query(lambda c: c.data == "ecp_main")
-async def ecp_main(callback: types.CallbackQuery):
+def render_ecp_main(catalog):
     builder = InlineKeyboardBuilder()
-    builder.button(text="Физическое лицо (ФЛ)", callback_data="ecp_type:fl")
-    builder.button(text="Не выпускаем ЭЦП на ИП. Только продление по действующей", callback_data="ecp_type:ip")
-    builder.button(text="Не выпускаем ЭЦП на ООО. Только продление по действующей", callback_data="ecp_type:ul")
-    builder.button(text="← Назад", callback_data="back_to_main")
+    builder.button(text="Физическое лицо (ФЛ)", callback_data=encode_callback(catalog, "ecp_type:fl"))
+    builder.button(text="Не выпускаем ЭЦП на ИП. Только продление по действующей", callback_data=encode_callback(catalog, "ecp_type:ip"))
+    builder.button(text="Не выпускаем ЭЦП на ООО. Только продление по действующей", callback_data=encode_callback(catalog, "ecp_type:ul"))
+    builder.add(back_button(catalog, "ecp_main"))
     builder.adjust(1)
-    await safe_edit_message(callback.message, "Выберите тип организации:", reply_markup=builder.as_markup(), parse_mode=None)
-    await callback.answer()
+    return Screen("Выберите тип организации:", builder.as_markup(), None)
 
-@dp.callback_query(lambda c: c.data.startswith("ecp_type:"))
-async def ecp_choose_type(callback: types.CallbackQuery):
-    ecp_type = callback.data.split(":")[1]
-    titles = {"fl": "Физическое лицо", "ip": "ИП", "ul": "ООО / Юридическое лицо"}
+def render_ecp_type(catalog, ecp_type, page=0):
+    items = catalog.ecps_data[ecp_type]
     builder = InlineKeyboardBuilder()
-    for code, name, desc, price in ECPS_DATA[ecp_type]:
-        builder.button(text=f"{name} — {price} ₽", callback_data=f"ecp_show:{code}")
-    builder.button(text="← Назад", callback_data="ecp_main")
-    builder.adjust(1)
-    await safe_edit_message(
-        callback.message,
-        f"ЭЦП для: {titles[ecp_type]}\nВыберите назначение:",
-        reply_markup=builder.as_markup(),
-        parse_mode=None
-    )
-    await callback.answer()
+    for code, name, desc, price in page_items(items, page):
+        builder.button(text=f"{name} — {price} ₽", callback_data=encode_callback(catalog, f"ecp_show:{code}"))
+    markup = render_section(catalog, builder, "ecp_type", ecp_type, page, page_count(items))
+    return Screen(f"ЭЦП для: {ECP_TITLES[ecp_type]}\nВыберите назначение:", markup, None)
 
-@dp.callback_query(lambda c: c.data.startswith("ecp_show:"))
-async def ecp_show_details(callback: types.CallbackQuery):
-    code = callback.data.split(":")[1]
-    info = ECPS_INFO.get(code)
-    if not info:
-        await callback.answer("Неизвестная ЭЦП", show_alert=True)
-        return
+def render_ecp_details(catalog, code):
+    info = catalog.ecps_info[code]
     text = f"📄 **{info['name']}**\n\n{info['desc']}\n\nСтоимость: **{info['price']} ₽**"
     builder = InlineKeyboardBuilder()
-    builder.button(text="← Назад", callback_data=f"ecp_type:{info['type']}")
-    await safe_edit_message(callback.message, text, reply_markup=builder.as_markup())
-    await callback.answer()
+    builder.add(lead_button(catalog, f"ecp_show:{code}"), *quote_buttons(catalog, f"ecp_show:{code}"))
+    builder.add(back_button(catalog, f"ecp_show:{code}"))
+    builder.adjust(1)
+    return Screen(text, builder.as_markup())
+
+@callback_route("ecp_main")
+async def ecp_main(callback: types.CallbackQuery, _: str):
+    await show_screen(callback, "ecp_main")
+
+@callback_route("ecp_type")
+async def ecp_choose_type(callback: types.CallbackQuery, ecp_type: str):
+    await show_screen(callback, f"ecp_type:{ecp_type}")
+
+@callback_route("ecp_show")
+async def ecp_show_details(callback: types.CallbackQuery, code: str):
+    await show_screen(callback, f"ecp_show:{code}", "Неизвестная ЭЦП")
 
 # =============================
 # БЛОК 2: Все для ЭЦП (аппаратура и ПО)
 # =============================
-CRYPTO_ITEMS = [
-    ("rt_lite", "Рутокен Lite", "Носитель ЭЦП начального уровня", "2000 ₽"),
-    ("rt_3", "Рутокен 3.0", "Носитель ЭЦП с расширенными возможностями", "2700 ₽"),
-    ("cp_15", "Крипто Про (15 мес.)", "Лицензия на СКЗИ КриптоПро на 15 месяцев", "2050 ₽"),
-    ("cp_life", "Крипто Про (бессрочная)", "Бессрочная лицензия", "3600 ₽"),
-    ("cp_arm", "Крипто АРМ (бессрочная)", "Лицензия для подписания документов ЭЦП", "4000 ₽"),
-    ("pc_setup", "Настройка ПК под ЭЦП", "Установка драйверов, КриптоПро, тестирование. Настройка ПК по удаленному доступу, либо у нас в офисе", "2500 ₽"),
-]
-
-CRYPTO_INFO = {}
-for code, name, desc, price in CRYPTO_ITEMS:
-    CRYPTO_INFO[code] = {"name": name, "desc": desc, "price": price}
-
-@dp.callback_query(lambda c: c.data == "crypto_main")
-async def crypto_main(callback: types.CallbackQuery):
+def render_crypto_main(catalog):
     builder = InlineKeyboardBuilder()
-    for code, name, desc, price in CRYPTO_ITEMS:
-        builder.button(text=f"{name} — {price}", callback_data=f"crypto_show:{code}")
-    builder.button(text="← Назад", callback_data="back_to_main")
+    for code, name, desc, price in catalog.crypto_items:
+        builder.button(text=f"{name} — {price}", callback_data=encode_callback(catalog, f"crypto_show:{code}"))
+    builder.add(back_button(catalog, "crypto_main"))
     builder.adjust(1)
-    await safe_edit_message(
-        callback.message,
-        "🔐 **Все для ЭЦП**\nАппаратные ключи, лицензии и настройка:",
-        reply_markup=builder.as_markup()
-    )
-    await callback.answer()
+    return Screen("🔐 **Все для ЭЦП**\nАппаратные ключи, лицензии и настройка:", builder.as_markup())
 
-@dp.callback_query(lambda c: c.data.startswith("crypto_show:"))
-async def crypto_show_details(callback: types.CallbackQuery):
-    code = callback.data.split(":")[1]
-    info = CRYPTO_INFO.get(code)
-    if not info:
-        await callback.answer("Товар не найден", show_alert=True)
-        return
+def render_crypto_details(catalog, code):
+    info = catalog.crypto_info[code]
     text = f"🔐 **{info['name']}**\n\n{info['desc']}\n\nСтоимость: **{info['price']}**"
     builder = InlineKeyboardBuilder()
-    builder.button(text="← Назад", callback_data="crypto_main")
-    await safe_edit_message(callback.message, text, reply_markup=builder.as_markup())
-    await callback.answer()
+    builder.add(lead_button(catalog, f"crypto_show:{code}"), *quote_buttons(catalog, f"crypto_show:{code}"))
+    builder.add(back_button(catalog, f"crypto_show:{code}"))
+    builder.adjust(1)
+    return Screen(text, builder.as_markup())
+
+@callback_route("crypto_main")
+async def crypto_main(callback: types.CallbackQuery, _: str):
+    await show_screen(callback, "crypto_main")
+
+@callback_route("crypto_show")
+async def crypto_show_details(callback: types.CallbackQuery, code: str):
+    await show_screen(callback, f"crypto_show:{code}", "Товар не найден")
 
 # =============================
 # БЛОК 3: Услуги по закупкам (без ЭЦП!)
 # =============================
-PROCUREMENTS = {
-    "44fz": [
-        ("base_44", "Базовое сопровождение по 44-ФЗ", "Полное оформление закупки: от подготовки заявки до подписания контракта. 1. Подготовка заявки 2. Подача заявки 3. Проведение аукциона 4. Подписание контракта", "от 7000 ₽"),
-        ("pp2571", "Подтверждение опыта по ПП 2571", "Прохождение аккредитации на 1 ЭТП для подтверждения опыта", "3000 ₽"),
-        ("struct_menu", "Структурированная форма закупки", "Анализ и заполнение показателей структуры", "см. подменю"),
-        ("urgent_44", "Срочность (<1 дня)", "Оформление заявки менее чем за 1 рабочий день до окончания подачи", "+3000 ₽"),
-        ("93_12", "Закупка по ч.12 ст.93", "Закупка единственного поставщика по 44-ФЗ. Размещение предложения на ЭТП", "от 5000 ₽"),
-    ],
-    "223fz": [
-        ("base_223", "Базовое сопровождение по 223-ФЗ", "Полное сопровождение закупки. 1. Подготовка заявки 2. Подача заявки 3. Проведение аукциона 4. Подписание контракта", "от 10000 ₽"),
-        ("urgent_223", "Срочность", "Ускоренное оформление", "+3000 ₽"),
-    ],
-    "com": [
-        ("base_com", "Коммерческие торги", "Подготовка заявки на коммерческих ЭТП. 1. Подготовка заявки 2. Подача заявки 3. Проведение аукциона 4. Подписание контракта", "от 10000 ₽"),
-        ("urgent_com", "Срочность", "Ускоренное оформление", "+3000 ₽"),
-    ],
-    "bankrot": [
-        ("base_bankrot", "Имущественные торги / банкротство", "Подготовка и подача заявки на торги по продаже и аренде имущества. 1. Подготовка заявки 2. Подача заявки 3. Проведение аукциона 4. Подписание контракта", "от 9000 ₽"),
-        ("urgent_bankrot", "Срочность", "Ускоренное оформление", "+3000 ₽"),
-    ],
-    "bereza": [
-        ("bereza", "Электронный магазин", "Подача предложения на Березка, Мос.рег.ру и др.. 1. Подача предложения 2. Подписание контракта", "3500 ₽"),
-    ],
-    "seldon": [
-        ("seldon_3", "Поиск торгов (3 мес.)", "Рассылка актуальных закупок по вашим критериям. Рассылка Селдон по ключевым словам, областям", "6000 ₽"),
-        ("seldon_6", "Поиск торгов (6 мес.)", "Подписка на полгода. Рассылка Селдон по ключевым словам, областям", "9000 ₽"),
-        ("seldon_9", "Поиск торгов (9 мес.)", "Подписка на 9 месяцев. Рассылка Селдон по ключевым словам, областям", "12 000 ₽"),
-        ("seldon_12", "Поиск торгов (12 мес.)", "Годовая подписка. Рассылка Селдон по ключевым словам, областям", "15 000 ₽"),
-        ("seldon_edit", "Изменение анкеты Селдон (>3 раз)", "Дополнительные правки после 3 бесплатных", "1000 ₽"),
-    ]
+PROC_TITLES = {
+    "44fz": "44-ФЗ",
+    "223fz": "223-ФЗ",
+    "com": "Коммерческие торги",
+    "bankrot": "Имущественные торги / банкротство",
+    "bereza": "Электронные магазины",
+    "seldon": "🔍 Поиск торгов",
 }
 
-STRUCTURE_ITEMS = [
-    ("struct_1_40", "Показатели 1–40", "Анализ и заполнение до 40 показателей", "+2500 ₽"),
-    ("struct_41_80", "Показатели 41–80", "Анализ и заполнение до 80 показателей", "+3500 ₽"),
-    ("struct_81_120", "Показатели 81–120", "Анализ и заполнение до 120 показателей", "+5000 ₽"),
-    ("struct_121_160", "Показатели 121–160", "Анализ и заполнение до 160 показателей", "+7000 ₽"),
-]
-
-OTHER_SERVICES = {
-    "reg": [
-        ("eruz", "Регистрация в ЕРУЗ", "Получение аккредитации в Едином реестре участников закупок", "5500 ₽"),
-        ("com_plat", "Регистрация на коммерческой площадке", "Аккредитация на одной коммерческой ЭТП", "от 5000 ₽"),
-        ("dop_one", "Доп. требования (1 площадка)", "Прохождение доп. аккредитации на одной площадки", "3000 ₽"),
-        ("dop_all", "Доп. требования (все площадки)", "Прохождение доп. аккредитации на всех площадках (8 Федеральный торговых площадок)", "7500 ₽"),
-    ],
-    "complex": [
-        ("complex_1", "Комплексное сопровождение (1 мес.)", "Полное сопровождение всех закупок клиента в течение месяца. 1. Максимум 20 Закопок за месяц 2. Делаем МЧД для участия в торгах 3. Проходим регистрацию на коммерческих площадках по присланным закупкам", "25 000 ₽ + 1%"),
-        ("complex_6", "Комплексное сопровождение (6 мес.)", "Ежемесячная абонентская поддержка. 1. Максимум 20 Закопок в месяц 2. Делаем МЧД для участия в торгах 3. Выпускае ЭЦП 4. Проходим регистрацию на коммерческих площадках по присланным закупкам 5. Рассылка тендеров", "20 000 ₽/мес + 1%"),
-    ],
-    "other": [
-        ("act", "Электронное актирование", "Подписание актов по заключённым контрактам", "2500 ₽"),
-        ("mchd", "МЧД", "Выдача машиночитаемой доверенности. В основном для торгов, но можем сделать любую", "1500 ₽"),
-        ("trade_long", "Участие в торгах (>5 часов)", "Сопровождение длительных торгов", "1500 ₽/час (раб.), 7000 ₽/час (нераб.)"),
-        ("ast_gos", "АСТ-ГОЗ (гособоронзаказ)", "Получение доступа и настройка ПК для гособоронзаказа", "15 000 ₽"),
-        ("etprf_gpb", "ETPRF.RU / Специализированная на ГПБ", "Получение доступа к закрытым площадкам", "12 000 ₽"),
-        ("fas", "Жалоба в ФАС", "Подготовка и подача жалобы на действия заказчика", "от 15 000 ₽"),
-        ("consult", "Консультации", "Индивидуальная консультация по закупкам и юридическим вопросам", "от 2000 ₽"),
-    ]
+SERVICE_TITLES = {
+    "reg": "Регистрация",
+    "complex": "Комплексное сопровождение",
+    "other": "Прочие услуги"
 }
 
-# Собираем все услуги для деталей
-ALL_SERVICES = {}
-for cat, items in PROCUREMENTS.items():
-    for code, name, desc, price in items:
-        ALL_SERVICES[code] = {"name": name, "desc": desc, "price": price, "cat": cat}
-for code, name, desc, price in STRUCTURE_ITEMS:
-    ALL_SERVICES[code] = {"name": name, "desc": desc, "price": price, "cat": "structure"}
-for cat in OTHER_SERVICES:
-    for code, name, desc, price in OTHER_SERVICES[cat]:
-        ALL_SERVICES[code] = {"name": name, "desc": desc, "price": price, "cat": cat}
-
-@dp.callback_query(lambda c: c.data == "services_main")
-async def services_main(callback: types.CallbackQuery):
+def render_services_main(catalog):
     builder = InlineKeyboardBuilder()
-    builder.button(text="44-ФЗ", callback_data="proc:44fz")
-    builder.button(text="223-ФЗ", callback_data="proc:223fz")
-    builder.button(text="Коммерческие торги", callback_data="proc:com")
-    builder.button(text="Имущественные торги / банкротство", callback_data="proc:bankrot")
-    builder.button(text="Электронные магазины (Березка и др.)", callback_data="proc:bereza")
-    builder.button(text="🔍 Поиск торгов", callback_data="proc:seldon")
-    builder.button(text="Регистрация (ЕРУЗ, площадки)", callback_data="svc:reg")
-    builder.button(text="Комплексное сопровождение", callback_data="svc:complex")
-    builder.button(text="Прочее (жалобы, МЧД и др.)", callback_data="svc:other")
-    builder.button(text="← Назад", callback_data="back_to_main")
+    builder.button(text="44-ФЗ", callback_data=encode_callback(catalog, "proc:44fz"))
+    builder.button(text="223-ФЗ", callback_data=encode_callback(catalog, "proc:223fz"))
+    builder.button(text="Коммерческие торги", callback_data=encode_callback(catalog, "proc:com"))
+    builder.button(text="Имущественные торги / банкротство", callback_data=encode_callback(catalog, "proc:bankrot"))
+    builder.button(text="Электронные магазины (Березка и др.)", callback_data=encode_callback(catalog, "proc:bereza"))
+    builder.button(text="🔍 Поиск торгов", callback_data=encode_callback(catalog, "proc:seldon"))
+    builder.button(text="Регистрация (ЕРУЗ, площадки)", callback_data=encode_callback(catalog, "svc:reg"))
+    builder.button(text="Комплексное сопровождение", callback_data=encode_callback(catalog, "svc:complex"))
+    builder.button(text="Прочее (жалобы, МЧД и др.)", callback_data=encode_callback(catalog, "svc:other"))
+    builder.add(back_button(catalog, "services_main"))
     builder.adjust(1)
-    await safe_edit_message(
-        callback.message,
-        "Выберите тип закупок или услугу:",
-        reply_markup=builder.as_markup(),
-        parse_mode=None
-    )
-    await callback.answer()
+    return Screen("Выберите тип закупок или услугу:", builder.as_markup(), None)
 
-@dp.callback_query(lambda c: c.data.startswith("proc:"))
-async def show_proc_list(callback: types.CallbackQuery):
-    cat = callback.data.split(":")[1]
-    titles = {
-        "44fz": "44-ФЗ",
-        "223fz": "223-ФЗ",
-        "com": "Коммерческие торги",
-        "bankrot": "Имущественные торги / банкротство",
-        "bereza": "Электронные магазины",
-        "seldon": "🔍 Поиск торгов",
-    }
+def render_proc_list(catalog, cat, page=0):
+    items = catalog.procurements[cat]
     builder = InlineKeyboardBuilder()
-    for code, name, desc, price in PROCUREMENTS[cat]:
+    for code, name, desc, price in page_items(items, page):
         if code == "struct_menu":
-            builder.button(text=name, callback_data="struct_menu")
+            builder.button(text=name, callback_data=encode_callback(catalog, "struct_menu"))
         else:
-            builder.button(text=f"{name} — {price}", callback_data=f"svc_show:{code}")
-    builder.button(text="← Назад", callback_data="services_main")
+            builder.button(text=f"{name} — {price}", callback_data=encode_callback(catalog, f"svc_show:{code}"))
+    markup = render_section(catalog, builder, "proc", cat, page, page_count(items))
+    return Screen(f"📋 **{PROC_TITLES[cat]}**", markup)
+
+def render_structure_menu(catalog):
+    builder = InlineKeyboardBuilder()
+    for code, name, desc, price in catalog.structure_items:
+        builder.button(text=f"{name} — {price}", callback_data=encode_callback(catalog, f"svc_show:{code}"))
+    builder.add(back_button(catalog, "struct_menu"))
     builder.adjust(1)
-    await safe_edit_message(
-        callback.message,
-        f"📋 **{titles[cat]}**",
-        reply_markup=builder.as_markup()
-    )
-    await callback.answer()
+    return Screen("📊 **Структура закупки (44-ФЗ)**\nВыберите блок показателей:", builder.as_markup())
 
-@dp.callback_query(lambda c: c.data == "struct_menu")
-async def show_structure_menu(callback: types.CallbackQuery):
+def render_other_services(catalog, cat, page=0):
+    items = catalog.other_services[cat]
     builder = InlineKeyboardBuilder()
-    for code, name, desc, price in STRUCTURE_ITEMS:
-        builder.button(text=f"{name} — {price}", callback_data=f"svc_show:{code}")
-    builder.button(text="← Назад", callback_data="proc:44fz")
+    for code, name, desc, price in page_items(items, page):
+        builder.button(text=f"{name} — {price}", callback_data=encode_callback(catalog, f"svc_show:{code}"))
+    markup = render_section(catalog, builder, "svc", cat, page, page_count(items))
+    return Screen(f"📋 **{SERVICE_TITLES[cat]}**", markup)
+
+def render_service_details(catalog, code):
+    info = catalog.all_services[code]
+    text = f"💼 **{info['name']}**\n\n{info['desc']}\n\nСтоимость: **{info['price']}**"
+    builder = InlineKeyboardBuilder()
+    builder.add(lead_button(catalog, f"svc_show:{code}"), *quote_buttons(catalog, f"svc_show:{code}"))
+    builder.add(back_button(catalog, f"svc_show:{code}"))
     builder.adjust(1)
-    await safe_edit_message(
-        callback.message,
-        "📊 **Структура закупки (44-ФЗ)**\nВыберите блок показателей:",
-        reply_markup=builder.as_markup()
-    )
-    await callback.answer()
+    return Screen(text, builder.as_markup())
 
-SERVICE_TITLES = {
-    "reg": "Регистрация",
-    "complex": "Комплексное сопровождение",
-    "other": "Прочие услуги"
-}
+@callback_route("services_main")
+async def services_main(callback: types.CallbackQuery, _: str):
+    await show_screen(callback, "services_main")
+
+@callback_route("proc")
+async def show_proc_list(callback: types.CallbackQuery, cat: str):
+    await show_screen(callback, f"proc:{cat}")
 
-@dp.callback_query(lambda c: c.data.startswith("svc:") and not c.data.startswith("svc_show:"))
-async def show_other_services(callback: types.CallbackQuery):
-    cat = callback.data.split(":")[1]
+@callback_route("struct_menu")
+async def show_structure_menu(callback: types.CallbackQuery, _: str):
+    await show_screen(callback, "struct_menu")
+
+@callback_route("svc")
+async def show_other_services(callback: types.CallbackQuery, cat: str):
+    await show_screen(callback, f"svc:{cat}")
+
+@callback_route("svc_show")
+async def show_service_details(callback: types.CallbackQuery, code: str):
+    await show_screen(callback, f"svc_show:{code}", "Услуга не найдена")
+
+# =============================
+# ЗАЯВКИ
+# =============================
+# На каждом экране с ценой есть кнопка «Оставить заявку». Выбранные опции
+# кодируются битовой маской прямо в callback_data (lead:<маска>:<экран>,
+# в компактном виде — id позиции и маска в base36),
+# поэтому состояние между нажатиями хранить не нужно. Заявки пишутся
+# в фоне пачками в append-only лог (JSON Lines), обработчик лишь ставит
+# запись в очередь.
+LEADS_PATH = os.getenv("LEADS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "leads.jsonl"))
+LEAD_BATCH_SIZE = int(os.getenv("LEAD_BATCH_SIZE", 100))
+LEAD_FLUSH_INTERVAL = float(os.getenv("LEAD_FLUSH_INTERVAL", 1))
+LEAD_QUEUE_SIZE = int(os.getenv("LEAD_QUEUE_SIZE", 10000))
+
+def lead_button(catalog, key: str):
+    return InlineKeyboardButton(text="📝 Оставить заявку", callback_data=encode_callback(catalog, f"lead:0:{key}"))
+
+def build_addons(ecps_data, procurements, structure_items):
+    # Опции — позиции с ценой «+N ₽» из того же раздела; к 44-ФЗ добавляются блоки структуры
+    addons = {}
+    for prefix, sections in (("ecp_show", ecps_data), ("svc_show", procurements)):
+        for cat, items in sections.items():
+            extra = [f"{prefix}:{code}" for code, name, desc, price in items if price.startswith("+")]
+            if cat == "44fz":
+                extra += [f"svc_show:{code}" for code, name, desc, price in structure_items]
+            for code, name, desc, price in items:
+                if not price.startswith("+") and code != "struct_menu":
+                    addons[f"{prefix}:{code}"] = extra
+    return addons
+
+def item_info(catalog, key: str):
+    # Название и цена позиции по ключу её экрана
+    action, _, code = key.partition(":")
+    if action == "ecp_show" and code in catalog.ecps_info:
+        info = catalog.ecps_info[code]
+        return info["name"], f"{info['price']} ₽"
+    if action == "crypto_show" and code in catalog.crypto_info:
+        info = catalog.crypto_info[code]
+        return info["name"], info["price"]
+    if action == "svc_show" and code in catalog.all_services:
+        info = catalog.all_services[code]
+        return info["name"], info["price"]
+    return None
+
+def parse_lead(argument: str):
+    mask, _, key = argument.partition(":")
+    return int(mask) if mask.isdigit() else 0, key
+
+def render_lead(catalog, key: str, mask: int):
+    name, price = item_info(catalog, key)
+    addons = catalog.addons.get(key, [])
+    lines = [f"📝 **Заявка: {name}**", f"Стоимость: {price}"]
     builder = InlineKeyboardBuilder()
-    for code, name, desc, price in OTHER_SERVICES[cat]:
-        builder.button(text=f"{name} — {price}", callback_data=f"svc_show:{code}")
-    builder.button(text="← Назад", callback_data="services_main")
+    if addons:
+        lines.append("\nДобавьте опции, если нужно:")
+    for i, addon in enumerate(addons):
+        addon_name, addon_price = item_info(catalog, addon)
+        mark = "✅" if mask & (1 << i) else "⬜"
+        builder.button(text=f"{mark} {addon_name} ({addon_price})", callback_data=encode_callback(catalog, f"lead:{mask ^ (1 << i)}:{key}"))
+    builder.button(text="📨 Отправить заявку", callback_data=encode_callback(catalog, f"lead_send:{mask}:{key}"))
+    builder.add(back_button(catalog, f"lead:0:{key}"))
     builder.adjust(1)
-    await safe_edit_message(
-        callback.message,
-        f"📋 **{SERVICE_TITLES[cat]}**",
-        reply_markup=builder.as_markup()
-    )
+    return Screen("\n".join(lines), builder.as_markup())
+
+class LeadWriter:
+    _STOP = object()
+
+    def __init__(self, path: str, batch_size: int, flush_interval: float, queue_size: int):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.task = None
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        # Не через spawn: общая отмена фоновых задач при остановке не должна терять заявки
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def submit(self, record: dict) -> bool:
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.error(f"Очередь заявок переполнена, заявка потеряна: {record}")
+            return False
+        return True
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            record = await self.queue.get()
+            if record is self._STOP:
+                return
+            batch = [record]
+            deadline = loop.time() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if record is self._STOP:
+                    stop = True
+                    break
+                batch.append(record)
+            await self._write(batch)
+            if stop:
+                return
+
+    async def _write(self, batch):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch)
+        try:
+            async with aiofiles.open(self.path, "a", encoding="utf-8") as f:
+                await f.write(data)
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f"Не удалось записать {len(batch)} заявок: {e}")
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    async def stop(self, timeout: float):
+        # Сигнал остановки встаёт в конец очереди: всё принятое до него будет записано
+        if self.task is None:
+            return
+        await self.queue.put(self._STOP)
+        try:
+            await asyncio.wait_for(asyncio.shield(self.task), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не записано заявок при остановке: {self.queue.qsize()}")
+        self.task = None
+
+    def stats(self):
+        return {
+            "pending": self.queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+lead_writer = LeadWriter(LEADS_PATH, LEAD_BATCH_SIZE, LEAD_FLUSH_INTERVAL, LEAD_QUEUE_SIZE)
+
+@callback_route("lead")
+async def lead_form(callback: types.CallbackQuery, argument: str):
+    catalog = CATALOG
+    mask, key = parse_lead(argument)
+    if item_info(catalog, key) is None:
+        await callback.answer("Позиция не найдена", show_alert=True)
+        return
+    await navigate(callback, render_lead(catalog, key, mask))
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("svc_show:"))
-async def show_service_details(callback: types.CallbackQuery):
-    code = callback.data.split(":")[1]
-    info = ALL_SERVICES.get(code)
-    if not info:
-        await callback.answer("Услуга не найдена", show_alert=True)
+@callback_route("lead_send")
+async def lead_send(callback: types.CallbackQuery, argument: str):
+    catalog = CATALOG
+    mask, key = parse_lead(argument)
+    item = item_info(catalog, key)
+    if item is None:
+        await callback.answer("Позиция не найдена", show_alert=True)
         return
-    text = f"💼 **{info['name']}**\n\n{info['desc']}\n\nСтоимость: **{info['price']}**"
+    addons = catalog.addons.get(key, [])
+    user = callback.from_user
+    lead_writer.submit({
+        "ts": time.time(),
+        "user_id": user.id,
+        "username": user.username,
+        "full_name": user.full_name,
+        "item": key,
+        "name": item[0],
+        "price": item[1],
+        "addons": [addon for i, addon in enumerate(addons) if mask & (1 << i)],
+        "catalog_version": catalog.version,
+    })
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="← В главное меню", callback_data=encode_callback(catalog, "back_to_main"))]])
+    await navigate(callback, Screen(
+        f"✅ Заявка на «{item[0]}» принята!\nМы свяжемся с вами в ближайшее время.",
+        kb,
+        None
+    ))
+    await callback.answer("Заявка отправлена")
+
+# =============================
+# РАСЧЁТ СТОИМОСТИ
+# =============================
+# Строки цен из каталога разбираются при загрузке в числовую модель.
+# Пользователь собирает позиции из разных разделов в расчёт (список ключей
+# экранов в FSM-хранилище) и сразу видит итог; отправленный расчёт
+# записывается в лог заявок.
+QUOTE_MAX_ITEMS = int(os.getenv("QUOTE_MAX_ITEMS", 20))
+PRICE_RE = re.compile(r"(\d[\d \u00a0]*)\s*(?:₽)?\s*(?:/\s*(час|мес))?")
+PERCENT_RE = re.compile(r"\+\s*(\d+(?:[.,]\d+)?)\s*%")
+# Почасовая ставка с необязательным пояснением: «7000 ₽/час (нераб.)»
+HOURLY_RE = re.compile(r"(\d[\d \u00a0]*)\s*(?:₽)?\s*/\s*час\s*(\([^)]*\))?")
+
+class Price(NamedTuple):
+    kind: str             # fixed, min («от»), surcharge («+»), hourly, none («см. подменю»)
+    amount: int = 0       # рубли; у hourly — первая (рабочая) ставка
+    percent: float = 0.0  # «+ 1%» сверх суммы
+    period: str = ""      # «мес» у абонентских услуг
+    rates: tuple = ()     # у hourly — все ставки: ((рубли, пояснение), ...)
+
+def parse_price(text: str) -> Price:
+    match = PRICE_RE.search(text)
+    if match is None:
+        return Price("none")
+    amount = int(re.sub(r"\D", "", match.group(1)))
+    unit = match.group(2) or ""
+    percent = PERCENT_RE.search(text)
+    percent = float(percent.group(1).replace(",", ".")) if percent else 0.0
+    head = text.strip().lower()
+    if head.startswith("+"):
+        kind = "surcharge"
+    elif head.startswith("от"):
+        kind = "min"
+    elif unit == "час":
+        kind = "hourly"
+    else:
+        kind = "fixed"
+    rates = ()
+    if kind == "hourly":
+        rates = tuple((int(re.sub(r"\D", "", rate)), note) for rate, note in HOURLY_RE.findall(text))
+    return Price(kind, amount, percent, "мес" if unit == "мес" else "", rates)
+
+def format_rub(amount: int) -> str:
+    return f"{amount:,}".replace(",", " ") + " ₽"
+
+def quote_total(catalog, keys):
+    # Разовая сумма; абонентские, почасовые и процентные части — отдельными строками
+    total = 0
+    minimum = False
+    extra = []
+    for key in keys:
+        price = catalog.prices[key]
+        name = item_info(catalog, key)[0]
+        if price.kind == "hourly":
+            rates = ", ".join(f"{format_rub(rate)}/час {note}".rstrip() for rate, note in price.rates)
+            extra.append(f"{name}: {rates}")
+        elif price.period:
+            extra.append(f"{name}: {format_rub(price.amount)}/{price.period}")
+        else:
+            total += price.amount
+            minimum |= price.kind == "min"
+        if price.percent:
+            extra.append(f"{name}: + {price.percent:g}%")
+    return ("от " if minimum else "") + format_rub(total), extra
+
+def quote_buttons(catalog, key: str):
+    if catalog.prices[key].kind == "none":
+        return []
+    return [
+        InlineKeyboardButton(text="➕ В расчёт", callback_data=encode_callback(catalog, f"quote_add:{key}")),
+        InlineKeyboardButton(text="🧮 Открыть расчёт", callback_data=encode_callback(catalog, "quote")),
+    ]
+
+def render_quote(catalog, keys):
     builder = InlineKeyboardBuilder()
-    cat = info["cat"]
-    if cat == "structure":
-        back_data = "struct_menu"
-    elif cat in PROCUREMENTS:
-        back_data = f"proc:{cat}"
+    if not keys:
+        builder.add(back_button(catalog, "quote", "← В главное меню"))
+        return Screen(
+            "🧮 **Расчёт стоимости**\n\nПока пусто. Добавляйте позиции кнопкой «➕ В расчёт» в карточках услуг.",
+            builder.as_markup()
+        )
+    lines = ["🧮 **Расчёт стоимости**", ""]
+    for key in keys:
+        name, price = item_info(catalog, key)
+        lines.append(f"• {name} — {price}")
+        builder.button(text=f"❌ {name}", callback_data=encode_callback(catalog, f"quote_del:{key}"))
+    total, extra = quote_total(catalog, keys)
+    lines.append(f"\nИтого: **{total}**")
+    if extra:
+        lines.append("Дополнительно:")
+        lines.extend(f"• {line}" for line in extra)
+    builder.button(text="📨 Отправить заявку", callback_data=encode_callback(catalog, "quote_send"))
+    builder.button(text="🗑 Очистить", callback_data=encode_callback(catalog, "quote_clear"))
+    builder.add(back_button(catalog, "quote", "← В главное меню"))
+    builder.adjust(1)
+    return Screen("\n".join(lines), builder.as_markup())
+
+def quote_context(callback: types.CallbackQuery):
+    chat_id = callback.message.chat.id if callback.message else callback.from_user.id
+    return dp.fsm.get_context(bot=callback.bot, chat_id=chat_id, user_id=callback.from_user.id)
+
+async def load_quote(catalog, state):
+    # Позиции, удалённые из каталога после перезагрузки, молча отбрасываются
+    data = await state.get_data()
+    return [key for key in data.get("quote", []) if key in catalog.prices]
+
+async def save_quote(state, keys):
+    data = await state.get_data()
+    if keys:
+        data["quote"] = keys
     else:
-        back_data = f"svc:{cat}"
-    builder.button(text="← Назад", callback_data=back_data)
-    await safe_edit_message(callback.message, text, reply_markup=builder.as_markup())
+        data.pop("quote", None)
+    await state.set_data(data)
+
+async def show_quote(callback: types.CallbackQuery, catalog, keys):
+    await navigate(callback, render_quote(catalog, keys))
+
+@callback_route("quote")
+async def quote_show(callback: types.CallbackQuery, _: str):
+    catalog = CATALOG
+    await show_quote(callback, catalog, await load_quote(catalog, quote_context(callback)))
+    await callback.answer()
+
+@callback_route("quote_add")
+async def quote_add(callback: types.CallbackQuery, key: str):
+    catalog = CATALOG
+    price = catalog.prices.get(key)
+    if price is None or price.kind == "none":
+        await callback.answer("Позиция не найдена", show_alert=True)
+        return
+    state = quote_context(callback)
+    keys = await load_quote(catalog, state)
+    if key in keys:
+        await callback.answer(f"Уже в расчёте. Итого: {quote_total(catalog, keys)[0]}")
+        return
+    if len(keys) >= QUOTE_MAX_ITEMS:
+        await callback.answer(f"В расчёте может быть не больше {QUOTE_MAX_ITEMS} позиций", show_alert=True)
+        return
+    keys.append(key)
+    await save_quote(state, keys)
+    await callback.answer(f"Добавлено в расчёт. Итого: {quote_total(catalog, keys)[0]}")
+
+@callback_route("quote_del")
+async def quote_del(callback: types.CallbackQuery, key: str):
+    catalog = CATALOG
+    state = quote_context(callback)
+    keys = [k for k in await load_quote(catalog, state) if k != key]
+    await save_quote(state, keys)
+    await show_quote(callback, catalog, keys)
     await callback.answer()
 
+@callback_route("quote_clear")
+async def quote_clear(callback: types.CallbackQuery, _: str):
+    await save_quote(quote_context(callback), [])
+    await show_quote(callback, CATALOG, [])
+    await callback.answer("Расчёт очищен")
+
+@callback_route("quote_send")
+async def quote_send(callback: types.CallbackQuery, _: str):
+    catalog = CATALOG
+    state = quote_context(callback)
+    keys = await load_quote(catalog, state)
+    if not keys:
+        await callback.answer("Расчёт пуст", show_alert=True)
+        return
+    total, extra = quote_total(catalog, keys)
+    user = callback.from_user
+    lead_writer.submit({
+        "ts": time.time(),
+        "user_id": user.id,
+        "username": user.username,
+        "full_name": user.full_name,
+        "item": "quote",
+        "name": "Расчёт стоимости",
+        "price": total,
+        "items": keys,
+        "extra": extra,
+        "catalog_version": catalog.version,
+    })
+    await save_quote(state, [])
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="← В главное меню", callback_data=encode_callback(catalog, "back_to_main"))]])
+    await navigate(callback, Screen(
+        f"✅ Заявка по расчёту на {total} принята!\nМы свяжемся с вами в ближайшее время.",
+        kb,
+        None
+    ))
+    await callback.answer("Заявка отправлена")
+
+# =============================
+# ПОЛЬЗОВАТЕЛИ И РАССЫЛКИ
+# =============================
+# Реестр пользователей (SQLite) пополняется из /start и callback-запросов:
+# новые id копятся в памяти и сбрасываются пачкой раз в USERS_FLUSH_INTERVAL.
+# Рассылка идёт по реестру порциями с заданной скоростью, прогресс
+# сохраняется после каждой порции, после падения рассылка продолжается
+# с места остановки. Сообщения рассылки идут с низким приоритетом.
+# Состояние рассылки живёт только в SQLite: одновременно идёт не больше
+# одной (уникальный индекс), выполняет её ровно один процесс — основной
+# или шард 0, — а отмена из любого шарда видна ему после текущей порции.
+USERS_DB_PATH = os.getenv("USERS_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.db"))
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", 5))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 20))
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", 50))
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", 2))
+
+class UserRegistry:
+    def __init__(self, path: str):
+        self.path = path
+        # Все обращения к SQLite идут через один поток
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="users-db")
+        self.conn = None
+        self.seen = set()
+        self.pending = set()
+        self.task = None
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "user_id INTEGER PRIMARY KEY, first_seen INTEGER NOT NULL, blocked INTEGER NOT NULL DEFAULT 0)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, created INTEGER NOT NULL, "
+            "last_user_id INTEGER NOT NULL DEFAULT 0, sent INTEGER NOT NULL DEFAULT 0, "
+            "failed INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'running')"
+        )
+        # Базы прежних версий могли накопить несколько запущенных рассылок — оставляем последнюю
+        conn.execute(
+            "UPDATE broadcasts SET status = 'cancelled' WHERE status = 'running' "
+            "AND id < (SELECT MAX(id) FROM broadcasts WHERE status = 'running')"
+        )
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS broadcasts_running ON broadcasts (status) WHERE status = 'running'")
+        conn.commit()
+        self.conn = conn
+        return [row[0] for row in conn.execute("SELECT user_id FROM users")]
+
+    async def open(self):
+        if self.conn is not None:
+            return
+        self.seen.update(await self.run(self._open))
+        self.task = asyncio.create_task(self._flush_loop())
+
+    def touch(self, user_id: int):
+        if user_id not in self.seen:
+            self.seen.add(user_id)
+            self.pending.add(user_id)
+
+    def _insert(self, user_ids):
+        now = int(time.time())
+        self.conn.executemany("INSERT OR IGNORE INTO users (user_id, first_seen) VALUES (?, ?)", [(u, now) for u in user_ids])
+        self.conn.commit()
+
+    async def flush(self):
+        if not self.pending or self.conn is None:
+            return
+        batch, self.pending = self.pending, set()
+        await self.run(self._insert, batch)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(USERS_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось сохранить пользователей: {e}")
+
+    async def close(self):
+        if self.conn is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        await self.flush()
+        await self.run(self.conn.close)
+        self.conn = None
+
+    # --- рассылки ---
+    def _create_broadcast(self, text: str):
+        # None — уже идёт другая рассылка (в любом из процессов)
+        try:
+            cursor = self.conn.execute("INSERT INTO broadcasts (text, created) VALUES (?, ?)", (text, int(time.time())))
+            self.conn.commit()
+        except sqlite3.IntegrityError:
+            self.conn.rollback()
+            return None
+        total = self.conn.execute("SELECT COUNT(*) FROM users WHERE blocked = 0").fetchone()[0]
+        return cursor.lastrowid, total
+
+    def _get_broadcast(self, broadcast_id: int):
+        return self.conn.execute(
+            "SELECT id, text, last_user_id, sent, failed, status FROM broadcasts WHERE id = ?", (broadcast_id,)
+        ).fetchone()
+
+    def _last_broadcast(self):
+        return self.conn.execute(
+            "SELECT id, text, last_user_id, sent, failed, status FROM broadcasts ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+
+    def _running_broadcast(self):
+        row = self.conn.execute("SELECT id FROM broadcasts WHERE status = 'running'").fetchone()
+        return row[0] if row else None
+
+    def _cancel_broadcast(self):
+        row = self.conn.execute("SELECT id, sent FROM broadcasts WHERE status = 'running'").fetchone()
+        if row is not None:
+            self.conn.execute("UPDATE broadcasts SET status = 'cancelled' WHERE id = ?", (row[0],))
+            self.conn.commit()
+        return row
+
+    def _recipients(self, after_user_id: int, limit: int):
+        # Постраничная выборка по ключу: память не зависит от числа получателей
+        return [row[0] for row in self.conn.execute(
+            "SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?", (after_user_id, limit)
+        )]
+
+    def _checkpoint(self, broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked, status: str):
+        # False — рассылку отменили (возможно, из другого процесса), продолжать не нужно
+        self.conn.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", [(u,) for u in blocked])
+        running = self.conn.execute("SELECT status = 'running' FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()[0]
+        self.conn.execute(
+            "UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, "
+            "status = CASE WHEN status = 'running' THEN ? ELSE status END WHERE id = ?",
+            (last_user_id, sent, failed, status, broadcast_id),
+        )
+        self.conn.commit()
+        return bool(running)
+
+user_registry = UserRegistry(USERS_DB_PATH)
+# Будит исполнителя рассылок, если команда пришла в его же процесс
+broadcast_wakeup = asyncio.Event()
+
+class UserRegistryMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            user_registry.touch(user.id)
+        return await handler(event, data)
+
+dp.message.outer_middleware(UserRegistryMiddleware())
+dp.callback_query.outer_middleware(UserRegistryMiddleware())
+
+async def run_broadcast(broadcast_id: int):
+    _, text, last_user_id, sent, failed, status = await user_registry.run(user_registry._get_broadcast, broadcast_id)
+    if status != "running":
+        return
+    loop = asyncio.get_running_loop()
+    interval = 1 / BROADCAST_RATE
+    send_priority.set(PRIORITY_LOW)
+    blocked = []
+    logger.info(f"📣 Рассылка #{broadcast_id}: старт с user_id > {last_user_id}")
+    try:
+        while True:
+            chunk = await user_registry.run(user_registry._recipients, last_user_id, BROADCAST_CHUNK)
+            if not chunk:
+                break
+            for user_id in chunk:
+                started = loop.time()
+                try:
+                    await bot.send_message(user_id, text)
+                    sent += 1
+                except TelegramForbiddenError:
+                    # Пользователь заблокировал бота — больше ему не пишем
+                    blocked.append(user_id)
+                    failed += 1
+                except Exception as e:
+                    failed += 1
+                    logger.warning(f"Рассылка #{broadcast_id}: не доставлено {user_id}: {e}")
+                last_user_id = user_id
+                await asyncio.sleep(max(0.0, interval - (loop.time() - started)))
+            running = await user_registry.run(
+                user_registry._checkpoint, broadcast_id, last_user_id, sent, failed, blocked, "running"
+            )
+            blocked = []
+            if not running:
+                logger.info(f"📣 Рассылка #{broadcast_id} отменена: отправлено {sent}, ошибок {failed}")
+                return
+    except asyncio.CancelledError:
+        # Остановка процесса или отмена: сохраняем прогресс, статус решает вызывающий
+        await user_registry.run(user_registry._checkpoint, broadcast_id, last_user_id, sent, failed, blocked, "running")
+        raise
+    await user_registry.run(user_registry._checkpoint, broadcast_id, last_user_id, sent, failed, blocked, "done")
+    logger.info(f"📣 Рассылка #{broadcast_id} завершена: отправлено {sent}, ошибок {failed}")
+
+async def broadcast_runner():
+    # Запускается в одном процессе: забирает рассылку в статусе running,
+    # созданную любым шардом или прерванную прошлым запуском
+    while True:
+        broadcast_id = await user_registry.run(user_registry._running_broadcast)
+        if broadcast_id is not None:
+            try:
+                await run_broadcast(broadcast_id)
+            except Exception as e:
+                logger.error(f"Рассылка #{broadcast_id}: ошибка, повтор через {BROADCAST_POLL_INTERVAL} с: {e}")
+                await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+            continue
+        broadcast_wakeup.clear()
+        try:
+            await asyncio.wait_for(broadcast_wakeup.wait(), BROADCAST_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+@dp.message(Command("broadcast"))
+async def broadcast_command(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    if not command.args:
+        await message.answer("Использование: /broadcast <текст сообщения>")
+        return
+    await user_registry.flush()
+    created = await user_registry.run(user_registry._create_broadcast, command.args)
+    if created is None:
+        running = await user_registry.run(user_registry._running_broadcast)
+        await message.answer(f"⏳ Уже идёт рассылка #{running}")
+        return
+    broadcast_id, total = created
+    broadcast_wakeup.set()
+    await message.answer(f"📣 Рассылка #{broadcast_id} запущена, получателей: {total}")
+
+@dp.message(Command("broadcast_status"))
+async def broadcast_status_command(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    row = await user_registry.run(user_registry._last_broadcast)
+    if row is None:
+        await message.answer("Рассылок ещё не было")
+        return
+    broadcast_id, _, last_user_id, sent, failed, status = row
+    await message.answer(f"📣 Рассылка #{broadcast_id}: {status}, отправлено {sent}, ошибок {failed}")
+
+@dp.message(Command("broadcast_cancel"))
+async def broadcast_cancel_command(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    row = await user_registry.run(user_registry._cancel_broadcast)
+    if row is None:
+        await message.answer("Активной рассылки нет")
+        return
+    broadcast_id, sent = row
+    await message.answer(f"🛑 Рассылка #{broadcast_id} остановлена, отправлено {sent}")
+
+# =============================
+# ПОИСК ПО КАТАЛОГУ
+# =============================
+# Инвертированный индекс строится вместе с каталогом: нормализованная
+# основа слова -> позиции. Отсортированный список основ позволяет
+# искать по префиксу (поиск по мере ввода) через bisect.
+SEARCH_LIMIT = 10
+RU_SUFFIXES = sorted([
+    "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ых", "их",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ую", "юю",
+    "ов", "ев", "ам", "ям", "ах", "ях", "ом", "ем",
+    "ы", "и", "а", "я", "о", "е", "у", "ю", "ь",
+], key=len, reverse=True)
+WORD_RE = re.compile(r"\w+")
+
+def normalize(text: str):
+    stems = []
+    for word in WORD_RE.findall(text.casefold().replace("ё", "е")):
+        for suffix in RU_SUFFIXES:
+            if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+                word = word[:-len(suffix)]
+                break
+        stems.append(word)
+    return stems
+
+class SearchDoc(NamedTuple):
+    key: str
+    title: str
+    price: str
+
+class SearchIndex:
+    def __init__(self, docs):
+        self.docs = docs
+        self.postings = {}
+        for doc_id, (doc, name, desc) in enumerate(docs):
+            # Совпадение в названии весит больше, чем в описании
+            for weight, text in ((2, name), (1, desc)):
+                for stem in normalize(text):
+                    entry = self.postings.setdefault(stem, {})
+                    entry[doc_id] = max(entry.get(doc_id, 0), weight)
+        self.stems = sorted(self.postings)
+
+    def _match(self, prefix: str):
+        scores = {}
+        i = bisect.bisect_left(self.stems, prefix)
+        while i < len(self.stems) and self.stems[i].startswith(prefix):
+            for doc_id, weight in self.postings[self.stems[i]].items():
+                scores[doc_id] = max(scores.get(doc_id, 0), weight)
+            i += 1
+        return scores
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT):
+        total = None
+        for stem in normalize(query):
+            scores = self._match(stem)
+            if total is None:
+                total = scores
+            else:
+                total = {doc_id: total[doc_id] + w for doc_id, w in scores.items() if doc_id in total}
+            if not total:
+                return []
+        if not total:
+            return []
+        ranked = sorted(total, key=lambda doc_id: (-total[doc_id], self.docs[doc_id][0].title))
+        return [self.docs[doc_id][0] for doc_id in ranked[:limit]]
+
+def build_search_index(catalog):
+    docs = []
+    for code, info in catalog.ecps_info.items():
+        docs.append((SearchDoc(f"ecp_show:{code}", info["name"], f"{info['price']} ₽"), info["name"], info["desc"]))
+    for code, info in catalog.crypto_info.items():
+        docs.append((SearchDoc(f"crypto_show:{code}", info["name"], info["price"]), info["name"], info["desc"]))
+    for code, info in catalog.all_services.items():
+        key = "struct_menu" if code == "struct_menu" else f"svc_show:{code}"
+        docs.append((SearchDoc(key, info["name"], info["price"]), info["name"], info["desc"]))
+    return SearchIndex(docs)
+
+def deep_link_payload(key: str) -> str:
+    # В параметре /start допустимы только [A-Za-z0-9_-]
+    return key.replace(":", "-", 1)
+
+@dp.message(Command("search"))
+async def search_command(message: types.Message, command: CommandObject):
+    if not command.args:
+        await message.answer("Использование: /search <запрос>\nНапример: /search жалоба фас")
+        return
+    catalog = CATALOG
+    results = catalog.search_index.search(command.args)
+    if not results:
+        await message.answer("Ничего не найдено. Попробуйте другой запрос.")
+        return
+    builder = InlineKeyboardBuilder()
+    for doc in results:
+        builder.button(text=f"{doc.title} — {doc.price}", callback_data=encode_callback(catalog, doc.key))
+    builder.button(text="← В главное меню", callback_data=encode_callback(catalog, "back_to_main"))
+    builder.adjust(1)
+    await message.answer(f"🔍 Найдено: {len(results)}", reply_markup=builder.as_markup())
+
+@dp.inline_query()
+async def inline_search(inline_query: types.InlineQuery):
+    catalog = CATALOG
+    results = catalog.search_index.search(inline_query.query) if inline_query.query.strip() else []
+    me = await bot.me()
+    articles = []
+    for doc in results:
+        screen = catalog.screens[doc.key]
+        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(
+            text="Открыть в боте", url=f"https://t.me/{me.username}?start={deep_link_payload(doc.key)}"
+        )]])
+        articles.append(types.InlineQueryResultArticle(
+            id=doc.key,
+            title=doc.title,
+            description=doc.price,
+            input_message_content=types.InputTextMessageContent(message_text=screen.text, parse_mode=screen.parse_mode),
+            reply_markup=kb,
+        ))
+    await inline_query.answer(articles, cache_time=60)
+
+# =============================
+# КАТАЛОГ: ЗАГРУЗКА И ГОРЯЧАЯ ПЕРЕЗАГРУЗКА
+# =============================
+# Цены и описания лежат в catalog.json. Новая версия каталога собирается
+# целиком (индексы и экраны) и подменяется одним присваиванием CATALOG,
+# поэтому обработчики, уже взявшие старую версию, дорабатывают на ней.
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+CATALOG_WATCH_INTERVAL = float(os.getenv("CATALOG_WATCH_INTERVAL", 5))
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+
+class Catalog(NamedTuple):
+    version: str
+    mtime: int
+    ecps_data: dict
+    crypto_items: list
+    procurements: dict
+    structure_items: list
+    other_services: dict
+    ecps_info: dict
+    crypto_info: dict
+    all_services: dict
+    screens: dict
+    search_index: Optional[SearchIndex]
+    addons: dict
+    item_ids: dict
+    item_keys: dict
+    prices: dict
+    parents: dict
+    callbacks: dict
+
+class CatalogError(ValueError):
+    pass
+
+def _parse_items(raw, where, prefix, item_ids):
+    # Постоянный id позиции попадает в callback_data, поэтому его нельзя менять и переиспользовать
+    if not isinstance(raw, list) or not raw:
+        raise CatalogError(f"{where}: ожидается непустой список позиций")
+    items = []
+    for i, item in enumerate(raw):
+        if not isinstance(item, dict):
+            raise CatalogError(f"{where}[{i}]: позиция должна быть объектом")
+        fields = []
+        for key in ("code", "name", "desc", "price"):
+            value = item.get(key)
+            if not isinstance(value, str) or not value.strip():
+                raise CatalogError(f"{where}[{i}]: поле {key!r} должно быть непустой строкой")
+            fields.append(value)
+        item_id = item.get("id")
+        if not isinstance(item_id, int) or isinstance(item_id, bool) or item_id < 0:
+            raise CatalogError(f"{where}[{i}]: поле 'id' должно быть неотрицательным целым числом")
+        item_ids[f"{prefix}:{fields[0]}"] = item_id
+        items.append(tuple(fields))
+    return items
+
+def _parse_sections(raw, titles, where, prefix, item_ids):
+    if not isinstance(raw, dict):
+        raise CatalogError(f"{where}: ожидается объект с разделами")
+    unknown = set(raw) - set(titles)
+    missing = set(titles) - set(raw)
+    if unknown or missing:
+        raise CatalogError(f"{where}: неизвестные разделы {sorted(unknown)}, отсутствуют {sorted(missing)}")
+    return {cat: _parse_items(raw[cat], f"{where}.{cat}", prefix, item_ids) for cat in titles}
+
+def _index(sections, key):
+    index = {}
+    for cat, items in sections.items():
+        for code, name, desc, price in items:
+            if code in index:
+                raise CatalogError(f"Повторяющийся код позиции: {code}")
+            index[code] = {"name": name, "desc": desc, "price": price, key: cat}
+    return index
+
+def build_catalog(data, version="", mtime=0):
+    if not isinstance(data, dict):
+        raise CatalogError("Каталог должен быть JSON-объектом")
+    item_ids = {}
+    ecps_data = _parse_sections(data.get("ecp"), ECP_TITLES, "ecp", "ecp_show", item_ids)
+    crypto_items = _parse_items(data.get("crypto"), "crypto", "crypto_show", item_ids)
+    procurements = _parse_sections(data.get("procurements"), PROC_TITLES, "procurements", "svc_show", item_ids)
+    structure_items = _parse_items(data.get("structure"), "structure", "svc_show", item_ids)
+    other_services = _parse_sections(data.get("other_services"), SERVICE_TITLES, "other_services", "svc_show", item_ids)
+    item_keys = {}
+    for key, item_id in item_ids.items():
+        if item_id in item_keys:
+            raise CatalogError(f"Повторяющийся id позиции: {item_id}")
+        item_keys[item_id] = key
+
+    ecps_info = _index(ecps_data, "type")
+    crypto_info = {code: {"name": name, "desc": desc, "price": price} for code, name, desc, price in crypto_items}
+    # Собираем все услуги для деталей
+    all_services = _index({**procurements, "structure": structure_items, **other_services}, "cat")
+
+    prices = {f"ecp_show:{code}": parse_price(info["price"]) for code, info in ecps_info.items()}
+    prices.update((f"crypto_show:{code}", parse_price(info["price"])) for code, info in crypto_info.items())
+    prices.update((f"svc_show:{code}", parse_price(info["price"])) for code, info in all_services.items())
+
+    catalog = Catalog(
+        version=version, mtime=mtime,
+        ecps_data=ecps_data, crypto_items=crypto_items, procurements=procurements,
+        structure_items=structure_items, other_services=other_services,
+        ecps_info=ecps_info, crypto_info=crypto_info, all_services=all_services,
+        screens={}, search_index=None,
+        addons=build_addons(ecps_data, procurements, structure_items),
+        item_ids=item_ids, item_keys=item_keys, prices=prices, parents={}, callbacks={},
+    )
+    catalog = catalog._replace(parents=build_screen_tree(catalog))
+    catalog = catalog._replace(screens=build_screens(catalog), search_index=build_search_index(catalog))
+    return catalog._replace(callbacks=build_callbacks(catalog))
+
+def load_catalog(path=CATALOG_PATH):
+    mtime = os.stat(path).st_mtime_ns
+    with open(path, "rb") as f:
+        raw = f.read()
+    try:
+        data = json.loads(raw)
+    except ValueError as e:
+        raise CatalogError(f"Некорректный JSON каталога: {e}") from e
+    return build_catalog(data, version=hashlib.sha1(raw).hexdigest()[:8], mtime=mtime)
+
+def build_screens(catalog):
+    screens = {
+        "back_to_main": render_main(catalog),
+        "ecp_main": render_ecp_main(catalog),
+        "crypto_main": render_crypto_main(catalog),
+        "services_main": render_services_main(catalog),
+        "struct_menu": render_structure_menu(catalog),
+    }
+    for ecp_type, items in catalog.ecps_data.items():
+        for page in range(page_count(items)):
+            screens[section_key("ecp_type", ecp_type, page)] = render_ecp_type(catalog, ecp_type, page)
+    for code in catalog.ecps_info:
+        screens[f"ecp_show:{code}"] = render_ecp_details(catalog, code)
+    for code in catalog.crypto_info:
+        screens[f"crypto_show:{code}"] = render_crypto_details(catalog, code)
+    for cat, items in catalog.procurements.items():
+        for page in range(page_count(items)):
+            screens[section_key("proc", cat, page)] = render_proc_list(catalog, cat, page)
+    for cat, items in catalog.other_services.items():
+        for page in range(page_count(items)):
+            screens[section_key("svc", cat, page)] = render_other_services(catalog, cat, page)
+    for code in catalog.all_services:
+        screens[f"svc_show:{code}"] = render_service_details(catalog, code)
+    return screens
+
+catalog_lock = asyncio.Lock()
+
+async def reload_catalog():
+    global CATALOG
+    async with catalog_lock:
+        # Разбор и рендер в отдельном потоке, чтобы не блокировать цикл событий
+        new_catalog = await asyncio.to_thread(load_catalog, CATALOG_PATH)
+        old_version = CATALOG.version
+        CATALOG = new_catalog
+    logger.info(f"📦 Каталог обновлён: {old_version} → {new_catalog.version}")
+    return new_catalog
+
+async def watch_catalog():
+    # mtime версии файла, которую загрузить не удалось (0 — файла нет)
+    failed_mtime = None
+    while True:
+        await asyncio.sleep(CATALOG_WATCH_INTERVAL)
+        try:
+            mtime = os.stat(CATALOG_PATH).st_mtime_ns
+        except OSError as e:
+            if failed_mtime != 0:
+                failed_mtime = 0
+                logger.error(f"Не удалось перезагрузить каталог: {e}")
+            continue
+        if mtime == CATALOG.mtime or mtime == failed_mtime:
+            continue
+        try:
+            await reload_catalog()
+        except Exception as e:
+            # Остаёмся на предыдущей версии и не перечитываем файл, пока его не изменят снова
+            failed_mtime = mtime
+            logger.error(f"Не удалось перезагрузить каталог: {e}")
+
+@dp.message(Command("reload"))
+async def reload_command(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    try:
+        catalog = await reload_catalog()
+    except Exception as e:
+        await message.answer(f"❌ Каталог не обновлён: {e}")
+        return
+    await message.answer(f"✅ Каталог обновлён, версия {catalog.version}")
+
+CATALOG = load_catalog(CATALOG_PATH)
+
 # =============================
 # НАВИГАЦИЯ
 # =============================
-@dp.callback_query(lambda c: c.data == "back_to_main")
-async def back_to_main(callback: types.CallbackQuery):
-    await start(callback.message)
-    await callback.answer()
+@callback_route("back_to_main")
+async def back_to_main(callback: types.CallbackQuery, _: str):
+    await show_screen(callback, "back_to_main")
 
 # =============================
 # ФУНКЦИЯ ЗАПУСКА БОТА
 # =============================
 async def run_bot():
-    try:
-        logger.info("🤖 Запуск Telegram бота...")
-        me = await bot.get_me()
-        logger.info(f"✅ Бот @{me.username} успешно запущен!")
-        logger.info(f"👤 Имя бота: {me.full_name}")
-        
-        # Запускаем поллинг
-        await dp.start_polling(bot, skip_updates=True)
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка в работе бота: {e}")
-        logger.info("🔄 Перезапуск через 10 секунд...")
-        await asyncio.sleep(10)
-        # Перезапускаем бота
-        asyncio.create_task(run_bot())
+    # Супервизор поллинга: перезапуск в том же цикле с экспоненциальной
+    # задержкой и джиттером, сессия бота при этом не пересоздаётся
+    backoff = Backoff(polling_backoff)
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        try:
+            logger.info("🤖 Запуск Telegram бота...")
+            me = await bot.get_me()
+            logger.info(f"✅ Бот @{me.username} успешно запущен!")
+            logger.info(f"👤 Имя бота: {me.full_name}")
+            # Вебхук от прежнего режима мешает getUpdates; накопленные апдейты сохраняются
+            await bot.delete_webhook()
+            
+            # Запускаем поллинг; сигналы остановки обрабатывает uvicorn
+            await dp.start_polling(
+                bot,
+                polling_timeout=POLLING_TIMEOUT,
+                backoff_config=polling_backoff,
+                handle_signals=False,
+                close_bot_session=False,
+            )
+            return
+            
+        except Exception as e:
+            # После долгой успешной работы начинаем отсчёт задержек заново
+            if loop.time() - started > polling_backoff.max_delay:
+                backoff.reset()
+            delay = next(backoff)
+            logger.error(f"❌ Ошибка в работе бота: {e}")
+            logger.info(f"🔄 Перезапуск через {delay:.1f} секунд...")
+            await asyncio.sleep(delay)
 
 # =============================
 # ЗАПУСК СЕРВЕРА ДЛЯ RENDER
@@ -453,11 +2654,14 @@ if __name__ == "__main__":
     
     logger.info(f"🌐 Запуск веб-сервера на порту {port}")
     
-    # Запускаем сервер
+    # Запускаем сервер. Без log_config uvicorn не ставит свои синхронные
+    # обработчики: его записи уходят в общую очередь корневого логгера,
+    # журнал запросов — с выборкой, как и прочие массовые события
     uvicorn.run(
         app,
         host="0.0.0.0",
         port=port,
-        log_level="info"
+        log_level=LOG_LEVEL.lower(),
+        log_config=None,
     )
 